@@ -0,0 +1,516 @@
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import hashlib
+import platform
+import argparse
+import resource
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from push import compare_metadata
+from utils import scan_folder, save_json, load_json
+from crypto_utils import encrypt_file, decrypt_file
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# synthetic trees, generated deterministically from a seed:
+#   small   - files of 64 B..2 KiB, 100 per dir, dirs 10 wide
+#   deep    - 10 files per dir in chains of 32 nested dirs
+#   renames - like small; the change renames 10% of the files and moves a whole top dir
+#   dups    - like small, but every content appears 10 times
+#   huge    - a few large files (--huge-files x --huge-mb), whatever the size asked for
+SCENARIOS = ('small', 'deep', 'renames', 'dups', 'huge')
+
+
+# ------- SYNTHETIC DATA -------
+
+def synthetic_meta(n_files, files_per_dir=100, fanout=10):
+    # n_files spread over a tree of dirs fanout wide, files_per_dir files each
+    files = {}
+    dirs = {''}
+    for i in range(n_files):
+        rel_dir = _tree_dir(i // files_per_dir, fanout)
+        parts = rel_dir.split(os.sep)
+        for k in range(1, len(parts) + 1):
+            dirs.add(os.path.join(*parts[:k]))
+        files[os.path.join(rel_dir, f"f{i}.dat")] = {
+            'mtime': 0.0, 'ctime': 0.0, 'size': i,
+            'hash': hashlib.sha1(str(i).encode()).hexdigest(),
+        }
+    return {'files': files, 'dirs': sorted(dirs)}
+
+
+def _tree_dir(d, fanout=10):
+    parts = []
+    while True:
+        parts.append(f"d{d % fanout}")
+        d //= fanout
+        if not d:
+            break
+    return os.path.join(*reversed(parts))
+
+
+def tree_layout(scenario, n_files, huge_files=4, huge_mb=64):
+    # -> [(rel path, size, content id)]
+    if scenario == 'huge':
+        return [(f"huge{i}.bin", huge_mb * 1024 * 1024, i) for i in range(huge_files)]
+
+    rnd = random.Random(n_files)
+    layout = []
+    for i in range(n_files):
+        if scenario == 'deep':
+            branch, level = divmod(i // 10, 32)
+            rel_dir = os.path.join(f"b{branch}", *(f"l{k}" for k in range(level + 1)))
+        else:
+            rel_dir = _tree_dir(i // 100)
+        content = i % max(1, n_files // 10) if scenario == 'dups' else i
+        layout.append((os.path.join(rel_dir, f"f{i}.dat"), rnd.randint(64, 2048), content))
+    return layout
+
+
+def _content(seed, content_id, size):
+    return random.Random(f"{seed}:{content_id}").randbytes(size)
+
+
+def make_tree(root, layout, seed=0):
+    # -> bytes written
+    total = 0
+    made = set()
+    for rel, size, content_id in layout:
+        path = os.path.join(root, rel)
+        parent = os.path.dirname(path)
+        if parent not in made:
+            os.makedirs(parent, exist_ok=True)
+            made.add(parent)
+        with open(path, 'wb') as f:
+            if size > 16 * 1024 * 1024:
+                block = _content(seed, content_id, 1024 * 1024)
+                for _ in range(size // len(block)):
+                    f.write(block)
+                f.write(block[:size % len(block)])
+            else:
+                f.write(_content(seed, content_id, size))
+        total += size
+    return total
+
+
+def mutate(meta, top_dir):
+    # drop the subtree under top_dir, rename 1%, modify 1% and add 1% of the rest
+    files = {}
+    for i, (rel, entry) in enumerate(meta['files'].items()):
+        if rel.startswith(top_dir + os.sep):
+            continue
+        if i % 100 == 1:
+            rel = rel + '.renamed'
+        elif i % 100 == 2:
+            entry = dict(entry, hash=entry['hash'][::-1])
+        files[rel] = entry
+        if i % 100 == 3:
+            files[rel + '.new'] = dict(entry, hash='n' + entry['hash'])
+    dirs = [d for d in meta['dirs'] if d != top_dir and not d.startswith(top_dir + os.sep)]
+    return {'files': files, 'dirs': dirs}
+
+
+def mutate_tree(root, scenario, layout, seed=1):
+    # the change a push has to carry, per scenario. -> (files touched, bytes written)
+    touched = 0
+    written = 0
+    if scenario == 'huge':
+        for rel, size, _ in layout:
+            with open(os.path.join(root, rel), 'r+b') as f:
+                f.seek(size // 2)
+                f.write(_content(seed, rel, 1024 * 1024))
+                f.seek(0, os.SEEK_END)
+                f.write(_content(seed + 1, rel, 1024 * 1024))
+            touched += 1
+            written += 2 * 1024 * 1024
+        return touched, written
+
+    if scenario == 'renames':
+        for i, (rel, _, _) in enumerate(layout):
+            if i % 10 == 1 and os.path.exists(os.path.join(root, rel)):
+                os.rename(os.path.join(root, rel), os.path.join(root, rel + '.renamed'))
+                touched += 1
+        top = os.path.join(root, 'd1')
+        if os.path.isdir(top):
+            os.makedirs(os.path.join(root, 'moved'), exist_ok=True)
+            os.rename(top, os.path.join(root, 'moved', 'd1'))
+        return touched, written
+
+    for i, (rel, size, _) in enumerate(layout):
+        path = os.path.join(root, rel)
+        if i % 100 == 1:
+            data = _content(seed, i, 256)
+            with open(path, 'ab') as f:
+                f.write(data)
+            written += len(data)
+        elif i % 100 == 2:
+            os.remove(path)
+        elif i % 100 == 3:
+            if scenario == 'dups':
+                shutil.copyfile(path, path + '.copy')
+                written += size
+            else:
+                data = _content(seed, f"new{i}", size)
+                with open(path + '.new', 'wb') as f:
+                    f.write(data)
+                written += len(data)
+        else:
+            continue
+        touched += 1
+    return touched, written
+
+
+# ------- MEASUREMENT -------
+
+def peak_rss_mb():
+    # VmHWM belongs to this process image; ru_maxrss also carries the high-water
+    # mark of whatever forked it, which would be the benchmark itself
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measured(fn, *args):
+    result = fn(*args)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def isolated(fn, *args):
+    # runs fn in a fresh interpreter, so the peak RSS reported is its own
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(_measured, fn, *args).result()
+
+
+# runs a script and writes its peak RSS to the file named by the first argument
+_PHASE_RUNNER = """
+import os, sys, runpy, atexit
+sys.path.insert(0, %r)
+from bench import peak_rss_mb
+out = sys.argv.pop(1)
+del sys.argv[0]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+atexit.register(lambda: open(out, 'w').write(str(peak_rss_mb())))
+runpy.run_path(sys.argv[0], run_name='__main__')
+""" % HERE
+
+
+def run_phase(name, args, log):
+    # runs one of the scripts as a child process: wall time, exit code, peak RSS
+    rss_file = log.name + '.rss'
+    start = time.perf_counter()
+    code = subprocess.run([sys.executable, '-c', _PHASE_RUNNER, rss_file, *args],
+                          stdout=log, stderr=subprocess.STDOUT).returncode
+    elapsed = time.perf_counter() - start
+    try:
+        with open(rss_file) as f:
+            peak = float(f.read())
+        os.remove(rss_file)
+    except (OSError, ValueError):
+        peak = None
+    return {'phase': name, 'seconds': elapsed, 'exit_code': code, 'peak_rss_mb': peak}
+
+
+# ------- BENCHMARKS -------
+
+def bench_diff(sizes):
+    results = []
+    for n in sizes:
+        old_meta = synthetic_meta(n)
+        new_meta = mutate(old_meta, 'd1')
+        start = time.perf_counter()
+        diff = compare_metadata(old_meta, new_meta)
+        elapsed = time.perf_counter() - start
+        results.append({
+            'files': n,
+            'seconds': elapsed,
+            'us_per_file': elapsed / n * 1e6,
+            **{k: len(v) for k, v in diff.items()},
+        })
+        print(f"diff {n:>9} files: {elapsed:8.3f}s  ({elapsed / n * 1e6:.2f} us/file)  "
+              f"deleted_dirs={len(diff['deleted_dirs'])} moved={len(diff['moved'])}")
+    return results
+
+
+def _scan_case(root, workers):
+    start = time.perf_counter()
+    cold = scan_folder(root, workers=workers)
+    cold_s = time.perf_counter() - start
+    start = time.perf_counter()
+    scan_folder(root, old_meta=cold, workers=workers)
+    warm_s = time.perf_counter() - start
+    return {'cold_seconds': cold_s, 'warm_seconds': warm_s}
+
+
+def bench_scan(sizes, scenarios, workdir, workers, huge_files, huge_mb):
+    results = []
+    for scenario in scenarios:
+        for n in (sizes if scenario != 'huge' else [huge_files]):
+            root = os.path.join(workdir, f"scan-{scenario}-{n}")
+            shutil.rmtree(root, ignore_errors=True)
+            layout = tree_layout(scenario, n, huge_files, huge_mb)
+            total = make_tree(root, layout)
+            r = isolated(_scan_case, root, workers)
+            shutil.rmtree(root, ignore_errors=True)
+            r.update({'scenario': scenario, 'files': len(layout), 'bytes': total,
+                      'cold_mb_s': total / 1024 / 1024 / r['cold_seconds'],
+                      'warm_files_s': len(layout) / r['warm_seconds']})
+            results.append(r)
+            print(f"scan {scenario:>8} {len(layout):>9} files: cold {r['cold_seconds']:7.2f}s "
+                  f"({r['cold_mb_s']:.1f} MB/s)  warm {r['warm_seconds']:7.2f}s "
+                  f"({r['warm_files_s']:.0f} files/s)  peak {r['peak_rss_mb']:.0f} MB")
+    return results
+
+
+def _crypto_case(src, keys, kwargs):
+    enc, out = src + '.enc', src + '.out'
+    start = time.perf_counter()
+    encrypt_file(src, keys['public'], output_file=enc, **kwargs)
+    enc_s = time.perf_counter() - start
+    start = time.perf_counter()
+    decrypt_file(enc, keys['private'], output_file=out)
+    dec_s = time.perf_counter() - start
+    size = os.path.getsize(enc)
+    os.remove(enc)
+    os.remove(out)
+    return {'encrypt_seconds': enc_s, 'decrypt_seconds': dec_s, 'encrypted_bytes': size}
+
+
+def bench_crypto(workdir, mb, keys):
+    results = []
+    src = os.path.join(workdir, 'crypto.bin')
+    size = make_tree(workdir, [('crypto.bin', mb * 1024 * 1024, 0)])
+    for label, kwargs in (('random', {}), ('random+zlib', {'codec': 'zlib'})):
+        r = isolated(_crypto_case, src, keys, kwargs)
+        r.update({'case': label, 'bytes': size,
+                  'encrypt_mb_s': mb / r['encrypt_seconds'],
+                  'decrypt_mb_s': mb / r['decrypt_seconds']})
+        results.append(r)
+        print(f"crypto {label:>12} {mb} MB: encrypt {r['encrypt_mb_s']:7.1f} MB/s  "
+              f"decrypt {r['decrypt_mb_s']:7.1f} MB/s  peak {r['peak_rss_mb']:.0f} MB")
+    os.remove(src)
+    return results
+
+
+def make_keys(workdir):
+    keys = {'public': os.path.join(workdir, 'public_key.pem'),
+            'private': os.path.join(workdir, 'private_key.pem')}
+    if not os.path.isfile(keys['private']):
+        subprocess.run([sys.executable, os.path.join(HERE, 'keygen.py')], cwd=workdir,
+                       check=True, stdout=subprocess.DEVNULL)
+    return keys
+
+
+def _git(cwd, *args):
+    subprocess.run(['git', *args], cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def setup_pcs(base, layout, keys, extra_settings):
+    # two PCs with the same data, and a local bare repo as the remote
+    remote = os.path.join(base, 'remote.git')
+    _git(base, 'init', '--bare', '-b', 'main', remote)
+    seed = os.path.join(base, 'seed')
+    _git(base, 'clone', remote, seed)
+    _git(seed, 'symbolic-ref', 'HEAD', 'refs/heads/main')
+    for n in (1, 2):
+        save_json(os.path.join(seed, 'updates', f'pc{n}.json'), {})
+    _git(seed, 'add', '.')
+    _git(seed, '-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+         'commit', '-qm', 'init')
+    _git(seed, 'push', 'origin', 'main')
+    shutil.rmtree(seed)
+
+    settings = []
+    for n in (1, 2):
+        pc = os.path.join(base, f'pc{n}')
+        make_tree(os.path.join(pc, 'data'), layout)
+        repo = os.path.join(pc, 'repo')
+        _git(base, 'clone', remote, repo)
+        _git(repo, 'config', 'user.name', f'bench-pc{n}')
+        _git(repo, 'config', 'user.email', 'bench@localhost')
+        cfg = {
+            'pc_number': n,
+            'folder_path': os.path.join(pc, 'data'),
+            'folder_metadata_path': os.path.join(pc, 'metadata.json'),
+            'folder_pc_1_updates_path': os.path.join(repo, 'updates', 'pc1.json'),
+            'folder_pc_2_updates_path': os.path.join(repo, 'updates', 'pc2.json'),
+            'files_to_sync_from_pc_1': os.path.join(repo, 'files', 'from_pc1'),
+            'files_to_sync_from_pc_2': os.path.join(repo, 'files', 'from_pc2'),
+            'git': {'repo_path': repo, 'remote': remote, 'branch': 'main', 'token': 'local'},
+            'public_key_path': keys['public'],
+            'private_key_path': keys['private'],
+        }
+        cfg.update(extra_settings)
+        if cfg.get('signatures_path'):
+            cfg['signatures_path'] = os.path.join(pc, 'signatures.json')
+        path = os.path.join(pc, 'settings.json')
+        save_json(path, cfg)
+        settings.append(path)
+    return settings
+
+
+def bench_cycle(sizes, scenarios, workdir, keys, extra_settings, huge_files, huge_mb, keep=False):
+    # init both PCs, change PC1's tree, push from PC1 and pull on PC2
+    results = []
+    for scenario in scenarios:
+        for n in (sizes if scenario != 'huge' else [huge_files]):
+            base = os.path.join(workdir, f"cycle-{scenario}-{n}")
+            shutil.rmtree(base, ignore_errors=True)
+            os.makedirs(base)
+            layout = tree_layout(scenario, n, huge_files, huge_mb)
+            total = sum(size for _, size, _ in layout)
+            pc1, pc2 = setup_pcs(base, layout, keys, extra_settings)
+
+            phases = []
+            with open(os.path.join(base, 'log.txt'), 'w') as log:
+                phases.append(run_phase('init-pc1', [os.path.join(HERE, 'init.py'), '-s', pc1], log))
+                phases.append(run_phase('init-pc2', [os.path.join(HERE, 'init.py'), '-s', pc2], log))
+                touched, written = mutate_tree(load_json(pc1)['folder_path'], scenario, layout)
+                phases.append(run_phase('push', [os.path.join(HERE, 'push.py'), '-s', pc1], log))
+                phases.append(run_phase('pull', [os.path.join(HERE, 'pull.py'), '-s', pc2], log))
+
+            synced = (_tree_hashes(load_json(pc1)['folder_path'])
+                      == _tree_hashes(load_json(pc2)['folder_path']))
+            init_s = phases[0]['seconds']
+            push_s = phases[2]['seconds']
+            r = {
+                'scenario': scenario, 'files': len(layout), 'bytes': total,
+                'touched': touched, 'bytes_changed': written,
+                'phases': phases, 'synced': synced,
+                'init_mb_s': total / 1024 / 1024 / init_s,
+                'push_files_s': len(layout) / push_s,
+                'repo_bytes': _dir_size(os.path.join(base, 'remote.git')),
+            }
+            results.append(r)
+            print(f"cycle {scenario:>8} {len(layout):>9} files: "
+                  + "  ".join(f"{p['phase']} {p['seconds']:.2f}s/{p['peak_rss_mb']:.0f}MB"
+                              for p in phases)
+                  + f"  {'synced' if synced else 'NOT SYNCED'}")
+            if any(p['exit_code'] for p in phases):
+                print(f"  a phase failed, see {os.path.join(base, 'log.txt')}", file=sys.stderr)
+            if not keep:
+                shutil.rmtree(base, ignore_errors=True)
+    return results
+
+
+def _tree_hashes(root):
+    return {rel: e['hash'] for rel, e in scan_folder(root)['files'].items()}
+
+
+def _dir_size(path):
+    total = 0
+    for r, _, names in os.walk(path):
+        for fn in names:
+            total += os.path.getsize(os.path.join(r, fn))
+    return total
+
+
+# ------- COMPARING RUNS -------
+
+def _timings(results):
+    # flattens a results file to {case: seconds}
+    out = {}
+    for r in results.get('diff', []):
+        out[f"diff/{r['files']}"] = r['seconds']
+    for r in results.get('scan', []):
+        out[f"scan/{r['scenario']}/{r['files']}/cold"] = r['cold_seconds']
+        out[f"scan/{r['scenario']}/{r['files']}/warm"] = r['warm_seconds']
+    for r in results.get('crypto', []):
+        out[f"crypto/{r['case']}/encrypt"] = r['encrypt_seconds']
+        out[f"crypto/{r['case']}/decrypt"] = r['decrypt_seconds']
+    for r in results.get('cycle', []):
+        for p in r['phases']:
+            out[f"cycle/{r['scenario']}/{r['files']}/{p['phase']}"] = p['seconds']
+    return out
+
+
+def compare_runs(old_path, new_path):
+    old, new = _timings(load_json(old_path)), _timings(load_json(new_path))
+    for case in sorted(old.keys() & new.keys()):
+        ratio = new[case] / old[case] if old[case] else float('inf')
+        flag = '  SLOWER' if ratio > 1.1 else ('  faster' if ratio < 0.9 else '')
+        print(f"{case:<40} {old[case]:9.3f}s -> {new[case]:9.3f}s  x{ratio:.2f}{flag}")
+
+
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, check=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'started_at': time.time(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="folder-sync benchmarks")
+    parser.add_argument('what', choices=['diff', 'scan', 'crypto', 'cycle', 'all', 'compare'],
+                        help="benchmark to run, or compare two result files")
+    parser.add_argument('results', nargs='*', help="compare: old and new JSON results")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                        help="number of files per run")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS),
+                        help="synthetic trees for scan and cycle")
+    parser.add_argument('--huge-files', type=int, default=4, help="files in the huge tree")
+    parser.add_argument('--huge-mb', type=int, default=64, help="size of each huge file")
+    parser.add_argument('--crypto-mb', type=int, default=256, help="file size for crypto")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="hash workers for scan")
+    parser.add_argument('--settings', default='{}',
+                        help="extra settings (JSON) for the cycle PCs, e.g. '{\"session_keys\": true}'")
+    parser.add_argument('--workdir', default=None, help="where trees are built (default: a temp dir)")
+    parser.add_argument('--keep', action='store_true', help="keep the cycle trees and logs")
+    parser.add_argument('--json', help="write results to this JSON file")
+    args = parser.parse_args()
+
+    if args.what == 'compare':
+        if len(args.results) != 2:
+            print("Error: compare needs two result files (old new).", file=sys.stderr)
+            sys.exit(1)
+        compare_runs(*args.results)
+        return
+
+    workdir = args.workdir or os.path.join(os.environ.get('TMPDIR', '/tmp'), 'folder-sync-bench')
+    os.makedirs(workdir, exist_ok=True)
+    results = {'environment': _environment()}
+    run = ['diff', 'scan', 'crypto', 'cycle'] if args.what == 'all' else [args.what]
+
+    if 'diff' in run:
+        results['diff'] = bench_diff(args.sizes)
+    if 'scan' in run:
+        results['scan'] = bench_scan(args.sizes, args.scenarios, workdir, args.workers,
+                                     args.huge_files, args.huge_mb)
+    if 'crypto' in run or 'cycle' in run:
+        keys = make_keys(workdir)
+    if 'crypto' in run:
+        results['crypto'] = bench_crypto(workdir, args.crypto_mb, keys)
+    if 'cycle' in run:
+        results['cycle'] = bench_cycle(args.sizes, args.scenarios, workdir, keys,
+                                       json.loads(args.settings), args.huge_files,
+                                       args.huge_mb, keep=args.keep)
+
+    if args.json:
+        save_json(args.json, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
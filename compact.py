@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from utils import load_json
+from git_utils import git, rev_parse, authed_url, repo_size
+from peers import load_peers
+
+
+def measure_clone(url, branch):
+    tmp = tempfile.mkdtemp(prefix='folder-sync-clone-')
+    try:
+        start = time.time()
+        subprocess.run(['git', 'clone', '--quiet', '--no-local', '--branch', branch, url, tmp],
+                       check=True, stdout=subprocess.DEVNULL)
+        return time.time() - start, repo_size(tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def rewrite_history(repo_path, tip, keep, note):
+    # a new chain with the trees (and authors/messages) of the last `keep`
+    # first-parent commits of tip, the oldest one becoming the root
+    commits = git(repo_path, 'rev-list', '--first-parent', '--reverse', '-n', str(keep), tip,
+                  capture=True).split()
+    parent = None
+    for i, commit in enumerate(commits):
+        fields = git(repo_path, 'log', '-1', '--format=%an%x00%ae%x00%ad%x00%cn%x00%ce%x00%cd%x00%B',
+                     commit, capture=True).split('\x00')
+        an, ae, ad, cn, ce, cd, message = fields
+        if i == 0:
+            message = f"{message.rstrip()}\n\n{note}"
+        env = dict(os.environ,
+                   GIT_AUTHOR_NAME=an, GIT_AUTHOR_EMAIL=ae, GIT_AUTHOR_DATE=ad,
+                   GIT_COMMITTER_NAME=cn, GIT_COMMITTER_EMAIL=ce, GIT_COMMITTER_DATE=cd)
+        args = ['git', 'commit-tree', f'{commit}^{{tree}}', '-m', message]
+        if parent:
+            args += ['-p', parent]
+        parent = subprocess.run(args, cwd=repo_path, env=env, check=True,
+                                stdout=subprocess.PIPE, text=True).stdout.strip()
+    return parent, len(commits)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compact the sync repo: rewrite its history to the current pending state "
+                    "(or the last N commits) and repack it."
+    )
+    parser.add_argument('-s', '--settings', required=True, help="Path to settings JSON")
+    parser.add_argument('--keep', type=int, default=1,
+                        help="number of most recent commits to keep (default: 1, a single snapshot)")
+    parser.add_argument('--no-measure', action='store_true',
+                        help="skip the clone-time measurements")
+    args = parser.parse_args()
+
+    cfg = load_json(args.settings)
+    git_cfg   = cfg.get('git', {})
+    repo_path = git_cfg.get('repo_path')
+    remote    = git_cfg.get('remote')
+    branch    = git_cfg.get('branch', 'main')
+    token     = git_cfg.get('token')
+
+    if not all([repo_path, remote]):
+        print("Error: incomplete git config.", file=sys.stderr)
+        sys.exit(1)
+    try:
+        me, peers = load_peers(cfg)
+    except (KeyError, ValueError) as e:
+        print(f"Error: bad peer settings: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.keep < 1:
+        print("Error: --keep must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+    url = authed_url(remote, token)
+
+    try:
+        # ------- MAKE SURE NOTHING LOCAL GETS LOST -------
+        # our cursors file stays untracked until our first pull commits it; the
+        # rewrite leaves untracked files as they are
+        cursors = os.path.relpath(peers[me]['cursors'], repo_path).replace(os.sep, '/')
+        if git(repo_path, 'status', '--porcelain', '--', '.', f':(exclude){cursors}',
+               capture=True):
+            print("Error: the sync repo has uncommitted changes; push or pull first.",
+                  file=sys.stderr)
+            sys.exit(1)
+        git(repo_path, 'remote', 'set-url', 'origin', url)
+        if git(repo_path, 'rev-parse', '--is-shallow-repository', capture=True) == 'true':
+            # a sparse-transport repo starts without history; the commits to keep
+            # have to be here (their trees are enough, blobs stay on the remote)
+            git(repo_path, 'fetch', '--unshallow', '--filter=blob:none', 'origin', branch)
+        else:
+            git(repo_path, 'fetch', 'origin', branch)
+        tip = rev_parse(repo_path, 'FETCH_HEAD')
+        unpushed = int(git(repo_path, 'rev-list', '--count', f'{tip}..HEAD', capture=True))
+        if unpushed:
+            print(f"Error: {unpushed} local commit(s) are not on the remote; push first.",
+                  file=sys.stderr)
+            sys.exit(1)
+
+        commits_before = int(git(repo_path, 'rev-list', '--count', tip, capture=True))
+        local_before = repo_size(repo_path)
+        if not args.no_measure:
+            clone_before = measure_clone(url, branch)
+
+        # ------- REWRITE -------
+        # the tip's tree holds every pending update and staged blob, so the
+        # snapshot keeps all unapplied work of every peer
+        note = f"Compacted-From: {tip}"
+        new_tip, kept = rewrite_history(repo_path, tip, args.keep, note)
+
+        # refuses if anyone pushed since our fetch
+        git(repo_path, 'push', f'--force-with-lease=refs/heads/{branch}:{tip}',
+            'origin', f'{new_tip}:refs/heads/{branch}')
+        git(repo_path, 'reset', '--hard', new_tip)
+        git(repo_path, 'fetch', 'origin', branch)
+
+        # ------- REPACK -------
+        git(repo_path, 'reflog', 'expire', '--expire=now', '--all')
+        git(repo_path, 'gc', '--prune=now', '--quiet')
+        if os.path.isdir(remote):
+            # a local (bare) remote can be repacked right here
+            git(remote, 'reflog', 'expire', '--expire=now', '--all')
+            git(remote, 'gc', '--prune=now', '--quiet')
+    except subprocess.CalledProcessError as e:
+        print(f"Error during compaction: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    local_after = repo_size(repo_path)
+    print(f"Compacted {remote} ({branch}): {commits_before} -> {kept} commit(s)")
+    print(f"  Local repo:  {local_before / 1024:.1f} KiB -> {local_after / 1024:.1f} KiB")
+    if not args.no_measure:
+        clone_after = measure_clone(url, branch)
+        print(f"  Clone:       {clone_before[1] / 1024:.1f} KiB in {clone_before[0]:.2f}s"
+              f" -> {clone_after[1] / 1024:.1f} KiB in {clone_after[0]:.2f}s")
+    print("Other peers follow the new history on their next pull.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,105 +1,444 @@
 import os
+import json
+import base64
+import hashlib
+import functools
+import threading
+import zlib
+import lzma
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import hmac
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.backends import default_backend
 
+import stats
+from utils import load_json, save_json
 
+try:
+    from cryptography.hazmat.decrepit.ciphers.modes import CFB
+except ImportError:
+    CFB = modes.CFB
+
+
+# streaming container (version 2):
+#   MAGIC || version (1 byte) || header length (4 bytes big endian) || header json
+#   then chunks of: ciphertext (chunk_size bytes, the last one shorter, maybe empty) || tag
+# every tag is HMAC-SHA256(mac_key, header || chunk index || final flag || ciphertext),
+# so chunks are verified as they are read and cannot be reordered or truncated.
+# files without MAGIC are the original whole-file format and are still decrypted.
+#
+# the file key is either RSA-wrapped in the header or, in session mode, derived from
+# a per-push session key and a per-file salt ('session', 'salt'). session keys are
+# RSA-wrapped once and stored in a manifest next to the blobs. a key for a single
+# recipient is wrapped as 'key'; for several, 'keys' maps each recipient's key id
+# (see key_id) to the key wrapped for it, so a blob is encrypted once for all peers.
+#
+# the plaintext may be compressed before encryption; the codec is named in the
+# header ('codec') and undone transparently on decrypt.
+MAGIC = b'FSENC'
+FORMAT_VERSION = 2
+CHUNK_SIZE = 1024 * 1024
+TAG_SIZE = 32
+SESSION_MANIFEST = 'sessions.json'
+
+CODECS = {
+    'zlib': (lambda: zlib.compressobj(6), zlib.decompressobj),
+    'lzma': (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+# already-compressed formats: not worth trying
+COMPRESSED_EXTENSIONS = {
+    '.7z', '.apk', '.avi', '.bz2', '.docx', '.epub', '.flac', '.gif', '.gz', '.heic',
+    '.jar', '.jpeg', '.jpg', '.lz4', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.odt',
+    '.ogg', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp', '.xlsx', '.xz', '.zip',
+    '.zst',
+}
+SAMPLE_SIZE = 64 * 1024
+MIN_SAMPLE_RATIO = 0.9
+
+OAEP = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+
+@functools.lru_cache(maxsize=None)
 def load_public_key(path: str):
     with open(path, 'rb') as f:
         return serialization.load_pem_public_key(f.read())
 
 
+@functools.lru_cache(maxsize=None)
 def load_private_key(path: str):
     with open(path, 'rb') as f:
         return serialization.load_pem_private_key(f.read(), password=None)
 
 
-def encrypt_file(input_file: str, public_key_path: str) -> str:
-    with open(input_file, 'rb') as f:
-        data = f.read()
+def key_id(public_key) -> str:
+    der = public_key.public_bytes(serialization.Encoding.DER,
+                                  serialization.PublicFormat.SubjectPublicKeyInfo)
+    return hashlib.sha256(der).hexdigest()[:16]
 
-    aes_key = os.urandom(32)
-    iv = os.urandom(16)
 
-    cipher = Cipher(algorithms.AES(aes_key), modes.CFB(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
-    ciphertext = encryptor.update(data) + encryptor.finalize()
+@functools.lru_cache(maxsize=None)
+def _own_key_id(private_key_path: str) -> str:
+    return key_id(load_private_key(private_key_path).public_key())
 
-    public_key = load_public_key(public_key_path)
 
-    encrypted_key = public_key.encrypt(
-        aes_key + iv,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+def wrap_key(key: bytes, public_key_path) -> dict:
+    # public_key_path: one path, or a list of them (one per recipient)
+    paths = [public_key_path] if isinstance(public_key_path, str) else sorted(set(public_key_path))
+    if not paths:
+        raise ValueError("No recipients to encrypt for.")
+    if len(paths) == 1:
+        wrapped = load_public_key(paths[0]).encrypt(key, OAEP)
+        return {'key': base64.b64encode(wrapped).decode('ascii')}
+    keys = {}
+    for path in paths:
+        public_key = load_public_key(path)
+        keys[key_id(public_key)] = base64.b64encode(public_key.encrypt(key, OAEP)).decode('ascii')
+    return {'keys': keys}
+
+
+def unwrap_key(wrapped: dict, private_key_path: str) -> bytes:
+    if 'key' in wrapped:
+        encrypted = wrapped['key']
+    else:
+        encrypted = wrapped.get('keys', {}).get(_own_key_id(private_key_path))
+        if encrypted is None:
+            raise ValueError("Not encrypted for this private key.")
+    return load_private_key(private_key_path).decrypt(base64.b64decode(encrypted), OAEP)
+
+
+def new_session(public_key_path) -> dict:
+    key = os.urandom(32)
+    return {
+        'id': os.urandom(8).hex(),
+        'key': key,
+        'wrapped': wrap_key(key, public_key_path),
+    }
+
+
+def save_session(manifest_path: str, session: dict):
+    manifest = load_json(manifest_path) or {}
+    manifest[session['id']] = session['wrapped']
+    save_json(manifest_path, manifest)
+
+
+def load_session_keys(manifest_path: str, private_key_path: str) -> dict:
+    # one RSA decrypt per session (i.e. per push), not per file. sessions not
+    # wrapped for this key are left out
+    manifest = load_json(manifest_path) or {}
+    keys = {}
+    for sid, wrapped in manifest.items():
+        if isinstance(wrapped, str):
+            wrapped = {'key': wrapped}  # manifests of single-recipient pushes
+        try:
+            keys[sid] = unwrap_key(wrapped, private_key_path)
+        except ValueError:
+            continue
+    return keys
 
-    h = hmac.HMAC(aes_key, hashes.SHA256(), backend=default_backend())
-    h.update(ciphertext)
-    tag = h.finalize()
 
-    # write out: encrypted_key length (4 bytes big endian) || encrypted_key || ciphertext || tag
-    encrypted_path = input_file + '.enc'
-    with open(encrypted_path, 'wb') as f:
-        f.write(len(encrypted_key).to_bytes(4, 'big'))
-        f.write(encrypted_key)
-        f.write(ciphertext)
-        f.write(tag)
+def prune_sessions(manifest_path: str, blob_paths):
+    # drop the sessions no remaining blob was encrypted with
+    manifest = load_json(manifest_path)
+    if not manifest:
+        return
+    used = {blob_session(p) for p in blob_paths}
+    kept = {sid: wrapped for sid, wrapped in manifest.items() if sid in used}
+    if not kept:
+        os.remove(manifest_path)
+    elif len(kept) != len(manifest):
+        save_json(manifest_path, kept)
+
+
+def blob_session(path: str):
+    # session id named in an encrypted file's header, if any
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC or f.read(1) != bytes([FORMAT_VERSION]):
+            return None
+        header_len = int.from_bytes(f.read(4), 'big')
+        return json.loads(f.read(header_len)).get('session')
+
+
+def pick_codec(path: str, codec: str = None):
+    # the codec to use for this file, or None when compression would not pay off
+    if not codec or codec == 'none':
+        return None
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec: {codec}")
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return None
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    if not sample or len(zlib.compress(sample, 1)) > len(sample) * MIN_SAMPLE_RATIO:
+        return None
+    return codec
+
+
+def encrypt_file(input_file: str, public_key_path: str, output_file: str = None,
+                 chunk_size: int = CHUNK_SIZE, session: dict = None, codec: str = None) -> str:
+    iv = os.urandom(16)
+    header = {'chunk_size': chunk_size, 'iv': iv.hex()}
+    codec = pick_codec(input_file, codec)
+    if codec:
+        header['codec'] = codec
+
+    if session:
+        salt = os.urandom(16)
+        file_key = _derive_file_key(session['key'], salt)
+        header['session'] = session['id']
+        header['salt'] = salt.hex()
+    else:
+        file_key = os.urandom(32)
+        header.update(wrap_key(file_key, public_key_path))
+    header_bytes = _pack_header(header)
+
+    enc_key, mac_key = _derive_keys(file_key)
+    encryptor = Cipher(algorithms.AES(enc_key), modes.CTR(iv), backend=default_backend()).encryptor()
+    mac = hmac.HMAC(mac_key, hashes.SHA256(), backend=default_backend())
+    mac.update(header_bytes)
+
+    encrypted_path = output_file or input_file + '.enc'
+    view, out = _buffers(chunk_size)
+    view = view[:chunk_size]
+
+    with open(input_file, 'rb') as fin, open(encrypted_path, 'wb') as fout:
+        src = _CompressingReader(fin, CODECS[codec][0](), chunk_size) if codec else fin
+        fout.write(header_bytes)
+        index = 0
+        while True:
+            n = _read_full(src, view)
+            final = n < chunk_size
+            m = encryptor.update_into(view[:n], out)
+            fout.write(out[:m])
+            fout.write(_chunk_mac(mac, index, final, out[:m]).finalize())
+            if final:
+                break
+            index += 1
+        stats.count('files_encrypted')
+        stats.count('encrypted_bytes', fin.tell())
 
     return encrypted_path
 
 
-def decrypt_file(encrypted_file: str, private_key_path: str) -> str:
-    with open(encrypted_file, 'rb') as f:
-        content = f.read()
+def decrypt_file(encrypted_file: str, private_key_path: str, output_file: str = None,
+                 session_keys: dict = None) -> str:
+    if output_file is None:
+        if encrypted_file.endswith('.enc'):
+            output_file = encrypted_file[:-4]
+        else:
+            output_file = encrypted_file + '.dec'
 
-    # parse lengths
-    key_len = int.from_bytes(content[:4], 'big')
-    offset = 4
-    encrypted_key = content[offset:offset + key_len]
-    offset += key_len
-    # ciphertext until last 32 bytes (HMAC-SHA256 tag)
-    ciphertext = content[offset:-32]
-    tag = content[-32:]
+    try:
+        with open(encrypted_file, 'rb') as fin, open(output_file, 'wb') as fout:
+            if fin.read(len(MAGIC)) == MAGIC:
+                _decrypt_stream(fin, fout, private_key_path, session_keys)
+            else:
+                fin.seek(0)
+                _decrypt_legacy(fin, fout, os.path.getsize(encrypted_file), private_key_path)
+            stats.count('files_decrypted')
+            stats.count('decrypted_bytes', fout.tell())
+    except BaseException:
+        # never leave unverified plaintext behind
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise
 
-    private_key = load_private_key(private_key_path)
+    return output_file
 
-    # decrypt AES key + IV
-    aes_key_iv = private_key.decrypt(
-        encrypted_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+
+def _decrypt_stream(fin, fout, private_key_path, session_keys):
+    version = fin.read(1)
+    if version != bytes([FORMAT_VERSION]):
+        raise ValueError(f"Unsupported encrypted file version: {version.hex()}")
+    header_len = int.from_bytes(fin.read(4), 'big')
+    header_json = fin.read(header_len)
+    header_bytes = MAGIC + version + header_len.to_bytes(4, 'big') + header_json
+    header = json.loads(header_json)
+
+    chunk_size = header['chunk_size']
+    iv = bytes.fromhex(header['iv'])
+    if 'session' in header:
+        session_key = (session_keys or {}).get(header['session'])
+        if session_key is None:
+            raise ValueError(f"Unknown session key: {header['session']}")
+        file_key = _derive_file_key(session_key, bytes.fromhex(header['salt']))
+    else:
+        file_key = unwrap_key(header, private_key_path)
+
+    enc_key, mac_key = _derive_keys(file_key)
+    decryptor = Cipher(algorithms.AES(enc_key), modes.CTR(iv), backend=default_backend()).decryptor()
+    mac = hmac.HMAC(mac_key, hashes.SHA256(), backend=default_backend())
+    mac.update(header_bytes)
+
+    codec = header.get('codec')
+    if codec:
+        if codec not in CODECS:
+            raise ValueError(f"Unknown compression codec: {codec}")
+        fout = _DecompressingWriter(fout, CODECS[codec][1]())
+
+    record = chunk_size + TAG_SIZE
+    view, out = _buffers(record)
+    view = view[:record]
+
+    index = 0
+    while True:
+        n = _read_full(fin, view)
+        if n < TAG_SIZE:
+            raise ValueError("Encrypted file is truncated.")
+        final = n < record
+        ciphertext = view[:n - TAG_SIZE]
+        try:
+            _chunk_mac(mac, index, final, ciphertext).verify(bytes(view[n - TAG_SIZE:n]))
+        except InvalidSignature:
+            raise ValueError("HMAC verification failed! Data is corrupted or tampered with.")
+        m = decryptor.update_into(ciphertext, out)
+        fout.write(out[:m])
+        if final:
+            break
+        index += 1
+
+    if codec:
+        fout.close()
+
+
+def _decrypt_legacy(fin, fout, file_size, private_key_path):
+    # encrypted_key length (4 bytes big endian) || encrypted_key || ciphertext || tag
+    key_len = int.from_bytes(fin.read(4), 'big')
+    encrypted_key = fin.read(key_len)
+    remaining = file_size - 4 - key_len - TAG_SIZE
+    if remaining < 0:
+        raise ValueError("Encrypted file is truncated.")
+
+    private_key = load_private_key(private_key_path)
+    aes_key_iv = private_key.decrypt(encrypted_key, OAEP)
     aes_key = aes_key_iv[:32]
     iv = aes_key_iv[32:]
 
-    # verify HMAC
     h = hmac.HMAC(aes_key, hashes.SHA256(), backend=default_backend())
-    h.update(ciphertext)
+    decryptor = Cipher(algorithms.AES(aes_key), CFB(iv), backend=default_backend()).decryptor()
+
+    # plaintext is written while the tag is computed; decrypt_file removes it on failure
+    view, out = _buffers(CHUNK_SIZE)
+    view = view[:CHUNK_SIZE]
+    while remaining:
+        n = _read_full(fin, view[:min(remaining, CHUNK_SIZE)])
+        if not n:
+            raise ValueError("Encrypted file is truncated.")
+        h.update(view[:n])
+        m = decryptor.update_into(view[:n], out)
+        fout.write(out[:m])
+        remaining -= n
+
     try:
-        h.verify(tag)
+        h.verify(fin.read(TAG_SIZE))
     except Exception:
         raise ValueError("HMAC verification failed! Data is corrupted or tampered with.")
 
-    # decrypt
-    cipher = Cipher(algorithms.AES(aes_key), modes.CFB(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
-    plaintext = decryptor.update(ciphertext) + decryptor.finalize()
 
-    # write
-    if encrypted_file.endswith('.enc'):
-        output_file = encrypted_file[:-4]
-    else:
-        output_file = encrypted_file + '.dec'
+def _pack_header(header):
+    header_json = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return MAGIC + bytes([FORMAT_VERSION]) + len(header_json).to_bytes(4, 'big') + header_json
 
-    with open(output_file, 'wb') as f:
-        f.write(plaintext)
 
-    return output_file
+def _derive_keys(file_key):
+    key_material = HKDF(
+        algorithm=hashes.SHA256(), length=64, salt=None, info=b'folder-sync v2'
+    ).derive(file_key)
+    return key_material[:32], key_material[32:]
+
+
+def _derive_file_key(session_key, salt):
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=salt, info=b'folder-sync file key'
+    ).derive(session_key)
+
+
+def _chunk_mac(mac, index, final, ciphertext):
+    h = mac.copy()
+    h.update(index.to_bytes(8, 'big') + (b'\x01' if final else b'\x00'))
+    h.update(ciphertext)
+    return h
+
+
+class _CompressingReader:
+    # readinto() over the compressed form of a file, for the chunked encryptor
+    def __init__(self, f, compressor, read_size):
+        self.f = f
+        self.compressor = compressor
+        self.read_size = read_size
+        self.pending = bytearray()
+        self.done = False
+
+    def readinto(self, view):
+        while len(self.pending) < len(view) and not self.done:
+            data = self.f.read(self.read_size)
+            if data:
+                self.pending += self.compressor.compress(data)
+            else:
+                self.pending += self.compressor.flush()
+                self.done = True
+        n = min(len(view), len(self.pending))
+        view[:n] = self.pending[:n]
+        del self.pending[:n]
+        return n
+
+
+class _DecompressingWriter:
+    # write() of compressed data, decompressed at most max_length bytes at a time:
+    # a highly compressible chunk must not expand in memory all at once
+    def __init__(self, f, decompressor, max_length=CHUNK_SIZE):
+        self.f = f
+        self.decompressor = decompressor
+        self.max_length = max_length
+
+    def write(self, data):
+        d = self.decompressor
+        while True:
+            out = d.decompress(data, self.max_length)
+            self.f.write(out)
+            if hasattr(d, 'unconsumed_tail'):
+                # zlib hands back the input it has not used yet; a full output may
+                # also leave more behind in its own buffer
+                data = d.unconsumed_tail
+                if not data and len(out) < self.max_length:
+                    return
+            else:
+                # lzma keeps the input itself and says when it has run dry
+                data = b''
+                if d.needs_input or d.eof:
+                    return
+
+    def close(self):
+        if hasattr(self.decompressor, 'flush'):
+            self.f.write(self.decompressor.flush())
+        if not self.decompressor.eof:
+            raise ValueError("Compressed stream is truncated.")
+
+
+_local = threading.local()
+
+
+def _buffers(size):
+    # per-thread read/output buffers, reused across files
+    bufs = getattr(_local, 'buffers', None)
+    if bufs is None or len(bufs[0]) < size:
+        # update_into needs block_size - 1 spare bytes in the output
+        bufs = (memoryview(bytearray(size)), memoryview(bytearray(size + 15)))
+        _local.buffers = bufs
+    return bufs
+
+
+def _read_full(f, view):
+    total = 0
+    while total < len(view):
+        n = f.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total
@@ -0,0 +1,110 @@
+import hashlib
+
+# block-level deltas for large modified files.
+#
+# a signature is the list of block digests of one version of a file, cut at fixed
+# block_size offsets. a delta against a base signature is a stream of ops:
+#   b'C' || first base block (8 bytes) || block count (8 bytes)   copy from the base
+#   b'L' || length (8 bytes) || data                               literal bytes
+#   b'E' || total size (8 bytes)                                   end
+# new blocks are matched at aligned offsets only, which covers appends and in-place
+# edits (logs, databases, disk images) but not insertions that shift the rest of a file.
+DELTA_MAGIC = b'FSDELTA1'
+BLOCK_SIZE = 1024 * 1024
+MIN_SIZE = 16 * 1024 * 1024
+
+
+def _block_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_signature(path, file_hash, block_size=BLOCK_SIZE):
+    blocks = []
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block_size), b''):
+            blocks.append(_block_digest(chunk))
+            size += len(chunk)
+    return {'hash': file_hash, 'size': size, 'block_size': block_size, 'blocks': blocks}
+
+
+def make_delta(new_path, new_hash, base_sig, delta_path):
+    # returns (delta size, signature of the new file)
+    block_size = base_sig['block_size']
+    base_index = {}
+    for i, digest in enumerate(base_sig['blocks']):
+        base_index.setdefault(digest, i)
+
+    blocks = []
+    size = 0
+    run = None  # [first base block, count]
+    with open(new_path, 'rb') as f, open(delta_path, 'wb') as out:
+        out.write(DELTA_MAGIC)
+        for chunk in iter(lambda: f.read(block_size), b''):
+            digest = _block_digest(chunk)
+            blocks.append(digest)
+            size += len(chunk)
+
+            i = base_index.get(digest)
+            if i is not None:
+                if run and run[0] + run[1] == i:
+                    run[1] += 1
+                    continue
+                _flush_run(out, run)
+                run = [i, 1]
+            else:
+                _flush_run(out, run)
+                run = None
+                out.write(b'L' + len(chunk).to_bytes(8, 'big'))
+                out.write(chunk)
+        _flush_run(out, run)
+        out.write(b'E' + size.to_bytes(8, 'big'))
+        delta_size = out.tell()
+
+    sig = {'hash': new_hash, 'size': size, 'block_size': block_size, 'blocks': blocks}
+    return delta_size, sig
+
+
+def _flush_run(out, run):
+    if run:
+        out.write(b'C' + run[0].to_bytes(8, 'big') + run[1].to_bytes(8, 'big'))
+
+
+def apply_delta(base_path, delta_path, out_path, block_size, hasher):
+    # rebuilds the new version into out_path; hasher sees every output byte so the
+    # caller can check the result. returns the block digests of the new version
+    blocks = []
+    with open(base_path, 'rb') as base, open(delta_path, 'rb') as delta, \
+            open(out_path, 'wb') as out:
+        if delta.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+            raise ValueError(f"Not a delta file: {delta_path}")
+
+        def emit(data):
+            out.write(data)
+            hasher.update(data)
+            blocks.append(_block_digest(data))
+
+        while True:
+            op = delta.read(1)
+            if op == b'C':
+                first = int.from_bytes(delta.read(8), 'big')
+                count = int.from_bytes(delta.read(8), 'big')
+                base.seek(first * block_size)
+                for _ in range(count):
+                    data = base.read(block_size)
+                    if not data:
+                        raise ValueError("Delta refers past the end of the base file.")
+                    emit(data)
+            elif op == b'L':
+                length = int.from_bytes(delta.read(8), 'big')
+                data = delta.read(length)
+                if len(data) != length:
+                    raise ValueError("Delta file is truncated.")
+                emit(data)
+            elif op == b'E':
+                size = int.from_bytes(delta.read(8), 'big')
+                if out.tell() != size:
+                    raise ValueError("Delta produced a file of the wrong size.")
+                return blocks
+            else:
+                raise ValueError("Delta file is truncated or corrupt.")
@@ -0,0 +1,171 @@
+import os
+import tempfile
+import subprocess
+
+# 'full': plain fetch and checkout of the whole repo. 'sparse': filtered fetches
+# (no history on the first one) and a checkout of only the dirs the peers use
+GIT_TRANSPORTS = ('full', 'sparse')
+
+
+def git(repo_path, *args, capture=False):
+    result = subprocess.run(
+        ['git', *args], cwd=repo_path, check=True,
+        stdout=subprocess.PIPE if capture else None, text=True
+    )
+    return result.stdout.strip() if capture else None
+
+
+def rev_parse(repo_path, ref):
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--verify', '--quiet', ref + '^{commit}'],
+            cwd=repo_path, check=True, stdout=subprocess.PIPE, text=True
+        ).stdout.strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def show_file(repo_path, ref, path):
+    # contents of path (relative to the repo) at ref, or None if it isn't there
+    result = subprocess.run(
+        ['git', 'show', f'{ref}:{path}'], cwd=repo_path,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    return result.stdout if result.returncode == 0 else None
+
+
+def is_ancestor(repo_path, a, b):
+    return subprocess.run(
+        ['git', 'merge-base', '--is-ancestor', a, b], cwd=repo_path
+    ).returncode == 0
+
+
+def authed_url(remote, token):
+    if token and remote.startswith('https://'):
+        return remote.replace('https://', f'https://{token}@')
+    return remote
+
+
+def replay_own(repo_path, onto, head, own):
+    # a commit on top of onto whose tree is onto's, but with our own paths (own: the
+    # files and dirs only this peer writes) as they are at head. built in a scratch
+    # index, so the working tree and the real index are left alone
+    rel_own = [os.path.relpath(p, repo_path).replace(os.sep, '/') for p in own]
+
+    def is_own(path):
+        return any(path == r or path.startswith(r + '/') for r in rel_own)
+
+    theirs = git(repo_path, 'ls-tree', '-r', '-z', onto, capture=True).split('\0')
+    ours = git(repo_path, 'ls-tree', '-r', '-z', head, '--', *rel_own, capture=True).split('\0')
+    entries = [e for e in theirs if e and not is_own(e.split('\t', 1)[1])]
+    entries += [e for e in ours if e]
+
+    fd, index = tempfile.mkstemp(prefix='folder-sync-index-')
+    os.close(fd)
+    os.remove(index)  # git wants to create it
+    env = dict(os.environ, GIT_INDEX_FILE=index)
+    try:
+        subprocess.run(['git', 'update-index', '-z', '--index-info'], cwd=repo_path, env=env,
+                       input=''.join(e + '\0' for e in entries), text=True, check=True)
+        tree = subprocess.run(['git', 'write-tree'], cwd=repo_path, env=env, check=True,
+                              stdout=subprocess.PIPE, text=True).stdout.strip()
+    finally:
+        if os.path.exists(index):
+            os.remove(index)
+    return git(repo_path, 'commit-tree', tree, '-p', onto, '-m',
+               'folder-sync: local changes replayed onto the compacted history', capture=True)
+
+
+def pull_remote(repo_path, branch, sparse=False, own=()):
+    # git pull that also follows a remote whose history was rewritten by compact.py:
+    # when the fetched history shares nothing with ours, we reset onto it. commits the
+    # remote never saw can only have changed our own paths (own), which are then
+    # replayed onto the new history; without own, we refuse rather than lose them
+    known = rev_parse(repo_path, f'refs/remotes/origin/{branch}')
+    head = rev_parse(repo_path, 'HEAD')
+    if sparse:
+        # commits and trees only: blobs are fetched on checkout, and only inside the
+        # sparse cone. a repo with no history yet starts from the remote tip alone
+        # (later fetches must not be shallow, or our own tip stops being an ancestor)
+        depth = ['--depth=1'] if head is None else []
+        git(repo_path, 'fetch', '--filter=blob:none', '--no-tags', *depth, 'origin', branch)
+    else:
+        git(repo_path, 'fetch', 'origin', branch)
+    fetched = rev_parse(repo_path, 'FETCH_HEAD')
+
+    if head is None or is_ancestor(repo_path, head, fetched):
+        git(repo_path, 'merge', '--ff-only', fetched)
+        return 'fast-forward'
+
+    merge_base = subprocess.run(
+        ['git', 'merge-base', head, fetched], cwd=repo_path, stdout=subprocess.PIPE
+    ).returncode == 0
+    if merge_base:
+        git(repo_path, 'merge', '--no-edit', fetched)
+        return 'merge'
+
+    unpushed = git(repo_path, 'rev-list', '--count', f'{known}..{head}' if known else head,
+                   capture=True)
+    if int(unpushed) and not own:
+        raise RuntimeError(
+            f"remote history was rewritten but {unpushed} local commit(s) never reached it; "
+            "refusing to reset"
+        )
+    if int(unpushed):
+        # --keep: uncommitted changes to our own files are carried over as they are
+        git(repo_path, 'reset', '--keep', replay_own(repo_path, fetched, head, own))
+        result = 'replay'
+    else:
+        git(repo_path, 'reset', '--hard', fetched)
+        result = 'reset'
+    git(repo_path, 'reflog', 'expire', '--expire=now', '--all')
+    git(repo_path, 'gc', '--prune=now', '--quiet')
+    return result
+
+
+def push_branch(repo_path, branch, sparse=False, own=()):
+    # every peer only writes its own files in the repo, so a push rejected because
+    # another peer pushed first goes through after merging theirs
+    try:
+        git(repo_path, 'push', 'origin', branch)
+    except subprocess.CalledProcessError:
+        pull_remote(repo_path, branch, sparse=sparse, own=own)
+        git(repo_path, 'push', 'origin', branch)
+
+
+def set_sparse(repo_path, dirs):
+    # check out only dirs (relative to the repo, cone mode); git rewrites the
+    # working tree only when the set changes
+    current = subprocess.run(
+        ['git', 'sparse-checkout', 'list'], cwd=repo_path,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    ).stdout.splitlines()  # fails (and stays empty) while the checkout isn't sparse
+    if sorted(current) != sorted(dirs):
+        git(repo_path, 'sparse-checkout', 'set', '--cone', *dirs)
+
+
+def tracked_files(repo_path, path):
+    # files under path in the index, as paths relative to the repo
+    out = git(repo_path, 'ls-files', '-z', '--', path, capture=True)
+    return {p for p in out.split('\0') if p}
+
+
+def commit_paths(repo_path, paths, message):
+    # stage exactly these paths (added, changed or removed) and commit: git stats
+    # nothing else in the working tree. paths gone from both disk and index are skipped
+    rels = ''.join(os.path.relpath(p, repo_path) + '\0' for p in paths)
+    subprocess.run(['git', 'update-index', '--add', '--remove', '-z', '--stdin'],
+                   cwd=repo_path, input=rels, text=True, check=True)
+    git(repo_path, 'commit', '-q', '-m', message)
+
+
+def repo_size(git_dir):
+    # bytes used by the object store of a repository (bare or not)
+    objects = os.path.join(git_dir, 'objects')
+    if not os.path.isdir(objects):
+        objects = os.path.join(git_dir, '.git', 'objects')
+    total = 0
+    for root, _, files in os.walk(objects):
+        for fn in files:
+            total += os.path.getsize(os.path.join(root, fn))
+    return total
@@ -0,0 +1,139 @@
+import os
+import re
+
+# gitignore-style ignore rules. they come from the 'ignore' list in the settings and
+# from a .fsyncignore file at the top of the synced folder (synced like any other
+# file, so every peer ends up with the same rules), after the defaults below.
+#
+#   # comment          blank lines and comments are skipped
+#   *.swp              no slash: matches the name at any depth
+#   build/             trailing slash: directories only
+#   /out, docs/*.pdf   a slash anywhere else: relative to the top of the folder
+#   **/cache, a/**/b   ** spans directories
+#   !keep.swp          re-includes what an earlier rule ignored
+#
+# like git, nothing under an ignored directory can be re-included: the scan does
+# not descend into it at all.
+IGNORE_FILE = '.fsyncignore'
+DEFAULT_IGNORES = [
+    '.*.fsync-tmp',  # pull's half-written files
+]
+
+
+def _translate(pattern):
+    # glob -> regex body, '/' being the only separator
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith('**', i):
+                at_start = i == 0 or pattern[i - 1] == '/'
+                if at_start and pattern.startswith('**/', i):
+                    out.append('(?:.*/)?')
+                    i += 3
+                    continue
+                out.append('.*')
+                i += 2
+                continue
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1  # a leading ] is part of the set
+            j = pattern.find(']', j)
+            if j < 0:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j]
+                if body[0] in '!^':
+                    body = '^' + body[1:]
+                out.append('[' + body.replace('\\', '\\\\') + ']')
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+def _compile(line):
+    # -> (regex, negate, dirs only), or None for blank lines and comments
+    line = line.rstrip('\n').rstrip()
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    if line.startswith('\\'):
+        line = line[1:]  # \# and \! at the start
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    anchored = '/' in line
+    body = _translate(line.lstrip('/'))
+    return (f'^{body}$' if anchored else f'^(?:.*/)?{body}$'), negate, dir_only
+
+
+def compile_rules(patterns):
+    # -> ignored(rel, is_dir=False) for paths relative to the folder, or None when
+    # there are no rules. without '!' rules every pattern goes into one regex
+    # (one for files, one for dirs); otherwise the last matching rule wins
+    rules = [r for r in map(_compile, patterns) if r]
+    if not rules:
+        return None
+    sep = os.sep
+
+    if not any(negate for _, negate, _ in rules):
+        file_re = re.compile('|'.join(f'(?:{rx})' for rx, _, dir_only in rules if not dir_only)
+                             or r'(?!)')
+        dir_re = re.compile('|'.join(f'(?:{rx})' for rx, _, _ in rules))
+
+        def ignored(rel, is_dir=False):
+            if sep != '/':
+                rel = rel.replace(sep, '/')
+            return bool((dir_re if is_dir else file_re).match(rel))
+        return ignored
+
+    compiled = [(re.compile(rx), negate, dir_only) for rx, negate, dir_only in rules]
+
+    def ignored(rel, is_dir=False):
+        if sep != '/':
+            rel = rel.replace(sep, '/')
+        for rx, negate, dir_only in reversed(compiled):
+            if (is_dir or not dir_only) and rx.match(rel):
+                return not negate
+        return False
+    return ignored
+
+
+def load_ignore(cfg):
+    # the rules of the folder in cfg: defaults, then settings, then .fsyncignore
+    patterns = list(DEFAULT_IGNORES) + list(cfg.get('ignore', []))
+    folder_path = cfg.get('folder_path')
+    if folder_path:
+        try:
+            with open(os.path.join(folder_path, IGNORE_FILE), encoding='utf-8') as f:
+                patterns += f.read().splitlines()
+        except FileNotFoundError:
+            pass
+    return compile_rules(patterns)
+
+
+def ignored_path(ignored, rel, is_dir=False):
+    # like ignored(), but also true under an ignored directory: for paths that do
+    # not come from a walk that already pruned those
+    if ignored is None:
+        return False
+    parts = rel.split(os.sep)
+    for k in range(1, len(parts)):
+        if ignored(os.sep.join(parts[:k]), True):
+            return True
+    return ignored(rel, is_dir)
@@ -2,9 +2,11 @@ import os
 import time
 import argparse
 import sys
-from utils import scan_folder, save_json, load_json
-import json
-from pathlib import Path
+from utils import scan_folder, save_json, load_json, norm_path, HASH_ALGORITHMS, DEFAULT_HASH
+from delta import file_signature, BLOCK_SIZE, MIN_SIZE
+from metadata_store import metadata_exists, save_metadata
+from ignore import load_ignore
+from peers import load_peers, load_log, save_log, save_cursors
 
 
 def main():
@@ -13,9 +15,11 @@ def main():
     args = parser.parse_args()
 
     settings = load_json(args.settings)
-    pc_number = int(settings.get('pc_number'))
     folder_path = settings.get('folder_path')
     folder_metadata_path = settings.get('folder_metadata_path')
+    hash_workers = int(settings.get('hash_workers', 1))
+    metadata_backend = settings.get('metadata_backend', 'json')
+    algorithm = settings.get('hash_algorithm', DEFAULT_HASH)
 
     if not all([folder_path, folder_metadata_path]):
         print("Error: settings.json missing required keys.", file=sys.stderr)
@@ -25,42 +29,54 @@ def main():
         print(f"Error: folder not found: {folder_path}", file=sys.stderr)
         sys.exit(1)
 
-    # making sure these files and directories exist
-    folder_pc_1_updates_path = settings.get('folder_pc_1_updates_path')
-    folder_pc_2_updates_path = settings.get('folder_pc_2_updates_path')
-    files_to_sync_from_pc_1 = settings.get('files_to_sync_from_pc_1')
-    files_to_sync_from_pc_2 = settings.get('files_to_sync_from_pc_2')
+    if algorithm not in HASH_ALGORITHMS:
+        print(f"Error: unknown hash_algorithm: {algorithm}", file=sys.stderr)
+        sys.exit(1)
 
-    if not all([folder_pc_1_updates_path, folder_pc_2_updates_path, 
-                files_to_sync_from_pc_1, files_to_sync_from_pc_2]):
-        print("Error: settings.json missing required keys.", file=sys.stderr)
+    # making sure our log, staging dir and cursors exist
+    try:
+        me, peers = load_peers(settings)
+    except (KeyError, ValueError) as e:
+        print(f"Error: bad peer settings: {e}", file=sys.stderr)
         print("Could not create necessary directories.")
     else:
-        os.makedirs(files_to_sync_from_pc_1, exist_ok=True)  # dir
-        os.makedirs(files_to_sync_from_pc_2, exist_ok=True)  # dir
-
-        folder_pc_1_updates_path = Path(folder_pc_1_updates_path)
-        if not folder_pc_1_updates_path.exists():
-            folder_pc_1_updates_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(folder_pc_1_updates_path, 'w') as f:
-                json.dump({}, f)
-
-        folder_pc_2_updates_path = Path(folder_pc_2_updates_path)
-        if not folder_pc_2_updates_path.exists():
-            folder_pc_2_updates_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(folder_pc_2_updates_path, 'w') as f:
-                json.dump({}, f)
+        os.makedirs(peers[me]['staging'], exist_ok=True)  # dir
+        if not os.path.isfile(peers[me]['log']):
+            save_log(peers[me]['log'], {'last_seq': 0, 'entries': []})
+        if not os.path.isfile(peers[me]['cursors']):
+            # we start from the same data as the others: what their logs already
+            # hold is in it
+            cursors = {name: load_log(peer['log'])['last_seq']
+                       for name, peer in peers.items()
+                       if name != me and os.path.isfile(peer['log'])}
+            save_cursors(peers, me, cursors)
 
     # initialize metadata
-    if not os.path.isfile(folder_metadata_path):
-        scan_data = scan_folder(folder_path, old_meta=None)
+    if not metadata_exists(folder_metadata_path, metadata_backend):
+        scan_data = scan_folder(folder_path, old_meta=None, workers=hash_workers,
+                                algorithm=algorithm, ignore=load_ignore(settings))
         metadata = {
             'generated_at': time.time(),
+            'hash_algorithm': algorithm,
             'files': scan_data['files'],
             'dirs':  sorted(scan_data['dirs']),  # from set to list -> serializable
+            'dir_mtimes': scan_data['dir_mtimes'],
         }
-        save_json(folder_metadata_path, metadata)
+        save_metadata(folder_metadata_path, metadata, metadata_backend)
         print(f"Initialized metadata -> {folder_metadata_path}")
+
+        # both sides start from the same data, so large files can be sent as deltas right away
+        signatures_path = settings.get('signatures_path')
+        if signatures_path and not os.path.isfile(signatures_path):
+            min_size = int(settings.get('delta_min_size', MIN_SIZE))
+            block_size = int(settings.get('delta_block_size', BLOCK_SIZE))
+            signatures = {
+                rel: {'synced': file_signature(norm_path(folder_path, rel), entry['hash'], block_size)}
+                for rel, entry in metadata['files'].items()
+                if entry['size'] >= min_size
+            }
+            save_json(signatures_path, signatures)
+            print(f"Initialized block signatures -> {signatures_path}")
         return
     else:
         print("Metadata file already exists.")
@@ -0,0 +1,179 @@
+import os
+import json
+import sqlite3
+
+from utils import load_json, save_json
+
+# folder metadata backends, picked with the 'metadata_backend' setting:
+#   json   - the whole tree in one JSON document at folder_metadata_path
+#   sqlite - one row per file, keyed by path; saves only write the rows that
+#            changed. a folder_metadata_path ending in .json keeps that name for
+#            the old document and the database lives next to it as .sqlite; an
+#            existing JSON document is migrated on first load.
+BACKENDS = ('json', 'sqlite')
+FILE_FIELDS = ('mtime', 'ctime', 'size', 'hash', 'ino', 'dev')
+ROW_COLUMNS = 'path, mtime, ctime, size, hash, extra, ino, dev'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path  TEXT PRIMARY KEY,
+    mtime REAL,
+    ctime REAL,
+    size  INTEGER,
+    hash  TEXT,
+    extra TEXT,
+    ino   INTEGER,
+    dev   INTEGER
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    path  TEXT PRIMARY KEY,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS info (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown metadata backend: {backend}")
+
+
+def sqlite_path(path):
+    root, ext = os.path.splitext(path)
+    return root + '.sqlite' if ext == '.json' else path
+
+
+def metadata_exists(path, backend='json'):
+    _check_backend(backend)
+    if backend == 'sqlite' and os.path.isfile(sqlite_path(path)):
+        return True
+    return os.path.isfile(path)
+
+
+def load_metadata(path, backend='json'):
+    _check_backend(backend)
+    if backend == 'json':
+        return load_json(path)
+
+    db = sqlite_path(path)
+    if not os.path.isfile(db):
+        if db != path and os.path.isfile(path):
+            meta = load_json(path)
+            save_metadata(path, meta, backend='sqlite')
+            print(f"Migrated metadata {path} -> {db}")
+            return meta
+        return None
+
+    with _connect(db) as conn:
+        files = {}
+        for row in conn.execute(f"SELECT {ROW_COLUMNS} FROM files"):
+            if row[4] is not None and row[5] is None and row[6] is not None:
+                files[row[0]] = {'mtime': row[1], 'ctime': row[2], 'size': row[3], 'hash': row[4],
+                                 'ino': row[6], 'dev': row[7]}
+            else:
+                files[row[0]] = _row_entry(row)
+        dir_mtimes = {}
+        dirs = []
+        for rel, mtime in conn.execute("SELECT path, mtime FROM dirs"):
+            dirs.append(rel)
+            if mtime is not None:
+                dir_mtimes[rel] = mtime
+        info = {k: json.loads(v) for k, v in conn.execute("SELECT key, value FROM info")}
+    conn.close()
+
+    meta = dict(info)
+    meta.update({'files': files, 'dirs': sorted(dirs), 'dir_mtimes': dir_mtimes})
+    return meta
+
+
+def save_metadata(path, meta, backend='json', previous=None):
+    # previous: the metadata as last loaded, so the sqlite backend can write only
+    # the rows that differ. without it every row is rewritten
+    _check_backend(backend)
+    if backend == 'json':
+        save_json(path, meta)
+        return
+
+    db = sqlite_path(path)
+    if previous is None or not os.path.isfile(db):
+        previous = {'files': {}, 'dirs': [], 'dir_mtimes': {}}
+        full = True
+    else:
+        full = False
+
+    old_files = previous.get('files', {})
+    new_files = meta['files']
+    old_dir_mtimes = previous.get('dir_mtimes', {})
+    new_dir_mtimes = meta.get('dir_mtimes', {})
+    old_dirs = set(previous.get('dirs', []))
+    new_dirs = set(meta.get('dirs', []))
+
+    conn = _connect(db)
+    with conn:
+        if full:
+            conn.execute("DELETE FROM files")
+            conn.execute("DELETE FROM dirs")
+            conn.execute("DELETE FROM info")
+        conn.executemany(
+            "DELETE FROM files WHERE path = ?",
+            ((rel,) for rel in old_files.keys() - new_files.keys())
+        )
+        conn.executemany(
+            f"INSERT OR REPLACE INTO files ({ROW_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (_file_row(rel, entry) for rel, entry in new_files.items()
+             if old_files.get(rel) != entry)
+        )
+        conn.executemany(
+            "DELETE FROM dirs WHERE path = ?",
+            ((d,) for d in old_dirs - new_dirs)
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?)",
+            ((d, new_dir_mtimes.get(d)) for d in new_dirs
+             if d not in old_dirs or old_dir_mtimes.get(d) != new_dir_mtimes.get(d))
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)",
+            ((k, json.dumps(v)) for k, v in meta.items()
+             if k not in ('files', 'dirs', 'dir_mtimes'))
+        )
+    conn.close()
+
+
+def _connect(db):
+    parent = os.path.dirname(db)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent, exist_ok=True)
+    conn = sqlite3.connect(db)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    # databases made before inodes were recorded
+    if 'ino' not in {row[1] for row in conn.execute("PRAGMA table_info(files)")}:
+        conn.execute("ALTER TABLE files ADD COLUMN ino INTEGER")
+        conn.execute("ALTER TABLE files ADD COLUMN dev INTEGER")
+    # a hash index older databases have: nothing reads it, every save paid for it
+    conn.execute("DROP INDEX IF EXISTS files_hash")
+    return conn
+
+
+def _file_row(rel, entry):
+    extra = {k: v for k, v in entry.items() if k not in FILE_FIELDS}
+    return (rel, entry.get('mtime'), entry.get('ctime'), entry.get('size'), entry.get('hash'),
+            json.dumps(extra) if extra else None, entry.get('ino'), entry.get('dev'))
+
+
+def _row_entry(row):
+    _, mtime, ctime, size, h, extra, ino, dev = row
+    entry = {'mtime': mtime, 'ctime': ctime, 'size': size}
+    if h is not None:
+        entry['hash'] = h
+    if ino is not None:
+        entry['ino'] = ino
+        entry['dev'] = dev
+    if extra:
+        entry.update(json.loads(extra))
+    return entry
@@ -0,0 +1,260 @@
+import os
+import re
+import json
+
+from utils import load_json, save_json, norm_path, DEFAULT_HASH
+from git_utils import show_file
+
+# sync between any number of peers through the git repo. each peer owns three things
+# in it that nobody else writes, so pushes from different peers always merge:
+#   its log         one entry per push with the operations and the blobs they need
+#   its staging dir the encrypted blobs its log refers to (one copy for all peers)
+#   its cursors     per other peer, the seq of the last entry of their log applied here
+# a peer drops the entries every other peer has applied, and the blobs only those
+# used, on its next push.
+#
+# settings name this machine ('peer') and every peer ('peers', name -> options):
+#   log             default <repo>/updates/<name>.json
+#   staging         default <repo>/files/<name>
+#   public_key_path default the top-level public_key_path (one key shared by all)
+# the two-machine settings (pc_number, folder_pc_N_updates_path,
+# files_to_sync_from_pc_N) still work: they are peers 'pc1' and 'pc2'.
+PEER_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]*$')
+OPS = ('added', 'deleted', 'modified', 'moved', 'moved_dirs', 'deleted_dirs')
+
+
+def load_peers(cfg):
+    # -> (this peer's name, {name: {'log', 'staging', 'cursors', 'public_key_path'}})
+    repo_path = (cfg.get('git') or {}).get('repo_path') or ''
+    default_key = cfg.get('public_key_path')
+
+    if 'peers' in cfg:
+        me = cfg.get('peer')
+        names = cfg['peers']
+        configured = {
+            name: {
+                'log': (opts or {}).get('log') or os.path.join(repo_path, 'updates', f'{name}.json'),
+                'staging': (opts or {}).get('staging') or os.path.join(repo_path, 'files', name),
+                'public_key_path': (opts or {}).get('public_key_path') or default_key,
+            }
+            for name, opts in names.items()
+        }
+    else:
+        me = f"pc{int(cfg['pc_number'])}"
+        configured = {
+            f'pc{n}': {
+                'log': cfg.get(f'folder_pc_{n}_updates_path'),
+                'staging': cfg.get(f'files_to_sync_from_pc_{n}'),
+                'public_key_path': default_key,
+            }
+            for n in (1, 2)
+        }
+
+    for name, peer in configured.items():
+        if not PEER_NAME.match(name):
+            raise ValueError(f"Invalid peer name: {name}")
+        if not all(peer.values()):
+            raise ValueError(f"Incomplete settings for peer: {name}")
+        peer['cursors'] = os.path.join(repo_path, 'cursors', f'{name}.json')
+    if me not in configured:
+        raise ValueError(f"This peer ({me}) is not listed in peers")
+    if len(configured) < 2:
+        raise ValueError("At least two peers are needed")
+    return me, configured
+
+
+def recipients(peers, me):
+    # public keys every blob has to be readable with
+    return sorted({p['public_key_path'] for name, p in peers.items() if name != me})
+
+
+def own_paths(peers, me):
+    # the repo paths only this peer writes
+    return [peers[me]['log'], peers[me]['cursors'], peers[me]['staging']]
+
+
+def sparse_dirs(peers, repo_path):
+    # the repo dirs a peer works with: the logs, the cursors and every staging dir.
+    # anything else (retired peers, old layouts) is left out of a sparse checkout
+    dirs = set()
+    for peer in peers.values():
+        for path in (os.path.dirname(peer['log']), os.path.dirname(peer['cursors']),
+                     peer['staging']):
+            rel = os.path.relpath(path, repo_path)
+            if rel != '.' and not rel.startswith('..'):
+                dirs.add(rel.replace(os.sep, '/'))
+    return sorted(dirs)
+
+
+def load_log(path):
+    return parse_log(load_json(path) or {})
+
+
+def parse_log(data):
+    if 'entries' in data:
+        return data
+    # a pending-updates file of the two-machine format: its operations are one entry
+    log = {'last_seq': 0, 'entries': []}
+    if any(data.get(op) for op in OPS):
+        entry = {k: v for k, v in data.items() if k != 'hash_algorithm'}
+        entry.update({'seq': 1, 'seen': {}, 'hash_algorithm': data.get('hash_algorithm', DEFAULT_HASH)})
+        log = {'last_seq': 1, 'entries': [entry]}
+    return log
+
+
+def legacy_staged(entry, staging):
+    # an entry of the two-machine format has no blob map: its files are staged per
+    # path, as <staging>/<rel>.enc, until every peer has applied it
+    if 'blobs' in entry:
+        return []
+    return [norm_path(staging, rel + '.enc')
+            for rel in entry.get('added', []) + entry.get('modified', [])]
+
+
+def published_seq(repo_path, branch, log_path):
+    # last seq of our log that made it to the remote, as of the last fetch or push.
+    # entries after it never left this machine, so no peer can have applied them
+    data = show_file(repo_path, f'refs/remotes/origin/{branch}',
+                     os.path.relpath(log_path, repo_path).replace(os.sep, '/'))
+    if data is None:
+        return 0
+    try:
+        return parse_log(json.loads(data)).get('last_seq', 0)
+    except ValueError:
+        return 0
+
+
+def save_log(path, log):
+    save_json(path, log)
+
+
+def load_cursors(peers, name):
+    return load_json(peers[name]['cursors']) or {}
+
+
+def save_cursors(peers, name, cursors):
+    save_json(peers[name]['cursors'], cursors)
+
+
+def applied_everywhere(peers, me):
+    # highest seq of our log that every other peer has applied
+    return min(load_cursors(peers, name).get(me, 0) for name in peers if name != me)
+
+
+def pending_entries(peers, me, cursors):
+    # -> [(source peer, entry)] not applied here yet, in the order to apply them.
+    # one log is applied in seq order; an entry also waits for the entries its
+    # pusher had applied when it was made ('seen'), so a change made on top of
+    # another peer's change lands after it. otherwise the oldest entry goes first
+    queues = {}
+    for name in peers:
+        if name == me:
+            continue
+        done = cursors.get(name, 0)
+        entries = [e for e in load_log(peers[name]['log'])['entries'] if e['seq'] > done]
+        if entries:
+            queues[name] = sorted(entries, key=lambda e: e['seq'])
+
+    applied = dict(cursors)
+    order = []
+    while queues:
+        def ready(name):
+            return all(applied.get(src, 0) >= seq
+                       for src, seq in queues[name][0].get('seen', {}).items()
+                       if src in queues)
+        candidates = [name for name in queues if ready(name)] or list(queues)
+        name = min(candidates, key=lambda n: (queues[n][0].get('generated_at', 0), n))
+        entry = queues[name].pop(0)
+        order.append((name, entry))
+        applied[name] = entry['seq']
+        if not queues[name]:
+            del queues[name]
+    return order
+
+
+def coalesce(entries):
+    # one entry with the net effect of consecutive entries of one log, or None when
+    # they don't reduce to one: paths are followed through the operations, so a file
+    # added then deleted disappears, one moved twice is moved once, and only the
+    # last content of a path is shipped. entries with directory moves can only come
+    # first (the other operations name paths as they are after those)
+    first, last = entries[0], entries[-1]
+    if any(e.get('moved_dirs') for e in entries[1:]):
+        return None
+    if any('blobs' not in e for e in entries):
+        return None  # files staged per path only make sense under their own path
+    if len({e.get('hash_algorithm', DEFAULT_HASH) for e in entries}) > 1:
+        return None
+
+    cur = {}      # path now -> {'origin': path before the entries or None, 'blob', 'delta'}
+    gone = set()  # paths before the entries whose content is gone
+    deleted_dirs = []
+    for e in entries:
+        for rel in e.get('deleted', []):
+            st = cur.pop(rel, {'origin': rel})
+            if st['origin']:
+                gone.add(st['origin'])
+        for old_rel, new_rel in e.get('moved', []):
+            cur[new_rel] = cur.pop(old_rel, {'origin': old_rel})
+        for rel in e.get('deleted_dirs', []):
+            if rel not in deleted_dirs:
+                deleted_dirs.append(rel)
+        for rel in e.get('added', []) + e.get('modified', []):
+            st = cur.setdefault(rel, {'origin': None if rel in e.get('added', []) else rel})
+            if rel in e.get('deltas', {}):
+                if 'blob' in st or 'delta' in st:
+                    return None  # a delta against a version shipped in between
+                st['delta'] = e['deltas'][rel]
+            else:
+                st.pop('delta', None)
+                st['blob'] = e.get('blobs', {}).get(rel)
+
+    moved = sorted([st['origin'], rel] for rel, st in cur.items()
+                   if st['origin'] and st['origin'] != rel)
+    # net moves are applied one after the other: a target that is still the source
+    # of another move would be overwritten
+    if {new for _, new in moved} & {old for old, _ in moved}:
+        return None
+
+    net = {
+        'seq': last['seq'],
+        'covers': first.get('covers', first['seq']),
+        'generated_at': first.get('generated_at'),
+        'hash_algorithm': last.get('hash_algorithm', DEFAULT_HASH),
+        'seen': last.get('seen', {}),
+        'added': sorted(rel for rel, st in cur.items() if st['origin'] is None),
+        'deleted': sorted(gone),
+        'modified': sorted(rel for rel, st in cur.items()
+                           if st['origin'] and ('blob' in st or 'delta' in st)),
+        'moved': moved,
+        'moved_dirs': first.get('moved_dirs', []),
+        'deleted_dirs': deleted_dirs,
+        'blobs': {rel: st['blob'] for rel, st in cur.items() if st.get('blob')},
+        'deltas': {rel: st['delta'] for rel, st in cur.items() if 'delta' in st},
+    }
+    return net
+
+
+def coalesce_pending(entries, boundaries=()):
+    # pending_entries() with each run of consecutive entries from one peer reduced
+    # to one entry where possible. boundaries: (peer, seq) a run has to end at
+    out = []
+    run = []
+
+    def flush():
+        if len(run) > 1:
+            net = coalesce([e for _, e in run])
+            if net is not None:
+                out.append((run[0][0], net))
+                return
+        out.extend(run)
+
+    for src, entry in entries:
+        if run and (run[-1][0] != src or entry.get('moved_dirs')
+                    or (src, run[-1][1]['seq']) in boundaries):
+            flush()
+            run = []
+        run.append((src, entry))
+    if run:
+        flush()
+    return out
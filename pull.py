@@ -4,175 +4,621 @@ import argparse
 import sys
 import shutil
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from utils import load_json, save_json, scan_folder, norm_path
-from crypto_utils import decrypt_file
+from utils import (load_json, save_json, scan_folder, norm_path, blob_path, new_hasher, temp_path,
+                   hash_file, hash_algorithm, stat_entry, settled_mtime, DEFAULT_HASH)
+from crypto_utils import decrypt_file, load_session_keys, SESSION_MANIFEST
+from delta import apply_delta, file_signature, BLOCK_SIZE, MIN_SIZE
+from metadata_store import load_metadata, save_metadata, metadata_exists
+from git_utils import (pull_remote, push_branch, authed_url, set_sparse, commit_paths,
+                       GIT_TRANSPORTS)
+from ignore import load_ignore, ignored_path
+from peers import (load_peers, load_cursors, save_cursors, pending_entries, coalesce_pending, OPS,
+                   sparse_dirs, own_paths)
+import stats
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Sync folder with other device. Pull method (decrypts incoming files)."
-    )
-    parser.add_argument('-s', '--settings', required=True, help="path to settings JSON")
-    args = parser.parse_args()
+def staged_path(sync_dir, blobs, rel):
+    # content-addressed blob, or the per-path layout of older pushes
+    if rel in blobs:
+        return blob_path(sync_dir, blobs[rel])
+    return norm_path(sync_dir, rel + '.enc')
+
+
+def move_dir(src, dst):
+    # one rename; a destination that already exists here gets src merged into it
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.rename(src, dst)
+        return
+    except OSError:
+        if not os.path.isdir(dst):
+            raise
+    for name in os.listdir(src):
+        s, d = os.path.join(src, name), os.path.join(dst, name)
+        if os.path.isdir(s) and not os.path.islink(s) and os.path.isdir(d):
+            move_dir(s, d)
+        else:
+            os.replace(s, d)
+    os.rmdir(src)
+
+
+def apply_content(folder_path, rel, enc_src, private_key_path, session_keys):
+    # decrypt straight next to the destination, then swap it in atomically
+    dst = norm_path(folder_path, rel)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = temp_path(dst)
+    decrypt_file(enc_src, private_key_path, output_file=tmp, session_keys=session_keys)
+    os.replace(tmp, dst)
+
+
+# a delta whose base was changed or removed here since the sender saw it
+CONFLICT = 'conflict'
+
+
+def apply_delta_update(folder_path, sync_dir, rel, delta, private_key_path, session_keys,
+                       signatures, algorithm=DEFAULT_HASH):
+    # algorithm: the one the sender's hashes were made with
+    # returns CONFLICT when our copy is no longer the base the delta was made against
+    # (it is left as it is); raises when the delta can't be applied
+    enc_src = blob_path(sync_dir, delta['blob'])
+    dst = norm_path(folder_path, rel)
+    if not os.path.isfile(enc_src):
+        raise FileNotFoundError("encrypted delta missing for update")
+    # the delta only covers the blocks that changed on the sender's side, so an edit
+    # here in a block it replaces would not show in the rebuilt hash: our copy has to
+    # be the delta's base. if it was removed or edited since, keep it, and forget the
+    # signature that no longer describes it so our next push ships it whole
+    if not os.path.isfile(dst) or hash_file(dst, algorithm) != delta['base']:
+        if signatures is not None:
+            signatures.pop(rel, None)
+        return CONFLICT
+
+    delta_path = temp_path(dst + '.delta')
+    tmp = temp_path(dst)
+    hasher = new_hasher(algorithm)
+    try:
+        decrypt_file(enc_src, private_key_path, output_file=delta_path, session_keys=session_keys)
+        blocks = apply_delta(dst, delta_path, tmp, delta['block_size'], hasher)
+        if hasher.hexdigest() != delta['hash']:
+            # our copy changed while it was being patched
+            os.remove(tmp)
+            if signatures is not None:
+                signatures.pop(rel, None)
+            return CONFLICT
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        if os.path.exists(delta_path):
+            os.remove(delta_path)
+
+    os.replace(tmp, dst)
+    if signatures is not None:
+        signatures[rel] = {'synced': {
+            'hash': delta['hash'],
+            'size': os.path.getsize(dst),
+            'block_size': delta['block_size'],
+            'blocks': blocks,
+        }}
+    return True
+
+
+def record_signature(signatures, folder_path, rel, file_hash, min_size, block_size):
+    # the version just applied is now on both sides
+    if signatures is None:
+        return
+    path = norm_path(folder_path, rel)
+    if file_hash and os.path.getsize(path) >= min_size:
+        signatures[rel] = {'synced': file_signature(path, file_hash, block_size)}
+    else:
+        signatures.pop(rel, None)
+
+
+def update_metadata(old_meta, folder_path, deleted, moved, deleted_dirs, contents,
+                    moved_dirs=()):
+    # metadata after the applied operations, from the sender's hashes and a fresh stat
+    # of only the touched paths. contents: rel -> content hash (None: hash it here)
+    algorithm = hash_algorithm(old_meta)
+    files = dict(old_meta['files'])
+    dirs = set(old_meta['dirs'])
+    dir_mtimes = dict(old_meta.get('dir_mtimes', {}))
+    touched = set()
+
+    def file_entry(rel, file_hash):
+        path = norm_path(folder_path, rel)
+        entry = stat_entry(os.stat(path))
+        entry['hash'] = file_hash or hash_file(path, algorithm)
+        return entry
+
+    # a renamed directory keeps its files' stat, only their paths change
+    for old_dir, new_dir in moved_dirs:
+        prefix = old_dir + os.sep
+        for rel in [f for f in files if f.startswith(prefix)]:
+            files[new_dir + rel[len(old_dir):]] = files.pop(rel)
+        for d in [d for d in dirs if d == old_dir or d.startswith(prefix)]:
+            dirs.discard(d)
+            moved_to = new_dir + d[len(old_dir):]
+            dirs.add(moved_to)
+            if d in dir_mtimes:
+                dir_mtimes[moved_to] = dir_mtimes.pop(d)
+        touched.add(os.path.dirname(old_dir))
+        touched.add(os.path.dirname(new_dir))
+
+    for rel in deleted:
+        if files.pop(rel, None) is None:
+            # a whole directory was removed
+            prefix = rel + os.sep
+            for f in [f for f in files if f.startswith(prefix)]:
+                del files[f]
+            for d in [d for d in dirs if d == rel or d.startswith(prefix)]:
+                dirs.discard(d)
+                dir_mtimes.pop(d, None)
+        touched.add(os.path.dirname(rel))
+
+    for old_rel, new_rel in moved:
+        entry = files.pop(old_rel, None)
+        files[new_rel] = file_entry(new_rel, entry and entry.get('hash'))
+        touched.add(os.path.dirname(old_rel))
+        touched.add(os.path.dirname(new_rel))
+
+    for rel in deleted_dirs:
+        touched.add('' if rel == '.' else rel)
 
+    for rel, file_hash in contents.items():
+        files[rel] = file_entry(rel, file_hash)
+        touched.add(os.path.dirname(rel))
+
+    # touched dirs and their parents may have been created or removed (removedirs
+    # also takes empty parents); record what is there now
+    seen = set()
+    for d in touched:
+        while d not in seen:
+            seen.add(d)
+            path = norm_path(folder_path, d) if d else folder_path
+            if os.path.isdir(path):
+                dirs.add(d)
+                mtime = os.stat(path).st_mtime
+                if settled_mtime(mtime):
+                    dir_mtimes[d] = mtime
+                else:
+                    dir_mtimes.pop(d, None)  # just changed: the next scan lists it
+            else:
+                dirs.discard(d)
+                dir_mtimes.pop(d, None)
+            if not d:
+                break
+            d = os.path.dirname(d)
+
+    return {
+        'generated_at': time.time(),
+        'hash_algorithm': algorithm,
+        'files': files,
+        'dirs':  sorted(dirs),
+        'dir_mtimes': dir_mtimes,
+    }
+
+
+def verify_metadata(meta, folder_path, workers=1, ignore=None):
+    # compare against a full scan that rehashes everything; returns the scan
+    scan = scan_folder(folder_path, old_meta=None, workers=workers,
+                       algorithm=hash_algorithm(meta), ignore=ignore)
+    problems = 0
+    for rel in sorted(meta['files'].keys() | scan['files'].keys()):
+        ours, actual = meta['files'].get(rel), scan['files'].get(rel)
+        if ours is None:
+            print(f"Verify: untracked file -> {rel}", file=sys.stderr)
+        elif actual is None:
+            print(f"Verify: file in metadata is missing -> {rel}", file=sys.stderr)
+        elif any(ours.get(k) != actual[k] for k in ('size', 'mtime', 'hash')):
+            print(f"Verify: metadata differs -> {rel}", file=sys.stderr)
+        else:
+            continue
+        problems += 1
+    for d in sorted(set(meta['dirs']) ^ scan['dirs']):
+        print(f"Verify: directory differs -> {d or '.'}", file=sys.stderr)
+        problems += 1
+    print(f"Verify: {problems} difference(s) from a full scan")
+    return scan
+
+
+class _ApplyJournal:
+    # which operations of the entries being applied are done, so an interrupted
+    # pull (ctrl-c, crash, power cut) picks up where it stopped. flushed on the first
+    # checkpoint, then at most once a second and on the way out; operations done
+    # after the last flush are
+    # found done again on the re-run (a move whose source is gone and whose
+    # destination exists, ...) or simply redone
+    def __init__(self, path, cursors):
+        self.path = path
+        data = load_json(path) or {}
+        self.entries = {
+            (e['source'], e['seq']): e for e in data.get('entries', [])
+            if e['seq'] > cursors.get(e['source'], 0)  # applied and saved since
+        }
+        self.resumed = bool(self.entries)
+        self.last_save = 0.0
+        self.dirty = False
+
+    def entry(self, src, seq):
+        key = (src, seq)
+        if key not in self.entries:
+            self.entries[key] = {'source': src, 'seq': seq, 'moved_dirs': [], 'deleted': [],
+                                 'moved': [], 'deleted_dirs': False, 'contents': {}}
+        return self.entries[key]
+
+    def checkpoint(self, force=False):
+        self.dirty = True
+        if force or time.time() - self.last_save >= 1.0:
+            self.save()
+
+    def save(self):
+        if self.dirty:
+            save_json(self.path, {'updated_at': time.time(), 'entries': list(self.entries.values())})
+            self.last_save = time.time()
+            self.dirty = False
+
+    def clear(self):
+        self.entries = {}
+        self.dirty = False
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def apply_entry(folder_path, entry, sync_dir, private_key_path, session_keys, signatures,
+                trust_hashes, delta_min_size, delta_block_size, apply_workers, journal, src,
+                ignore=None):
+    # applies the operations of one log entry; returns (dir moves done, moves done,
+    # deletes done, rel -> content hash of the applied files, failed rels, conflicted
+    # rels). operations the journal has as done are skipped, apart from their
+    # signature bookkeeping
+    # paths our ignore rules cover are left as they are here
+    def keep(rel):
+        return not ignored_path(ignore, rel)
+
+    added        = [rel for rel in entry.get('added', []) if keep(rel)]
+    deleted      = [rel for rel in entry.get('deleted', []) if keep(rel)]
+    modified     = [rel for rel in entry.get('modified', []) if keep(rel)]
+    moved        = [m for m in entry.get('moved', []) if keep(m[0]) and keep(m[1])]
+    moved_dirs   = [m for m in entry.get('moved_dirs', []) if keep(m[0]) and keep(m[1])]
+    deleted_dirs = [rel for rel in entry.get('deleted_dirs', []) if rel == '.' or keep(rel)]
+    blobs        = entry.get('blobs', {})          # rel -> staged blob id
+    deltas       = entry.get('deltas', {})         # rel -> delta against our version
+    sender_hash  = entry.get('hash_algorithm', DEFAULT_HASH)
+    done         = journal.entry(src, entry['seq'])
+    done_deleted = set(done['deleted'])
+    done_moved   = {tuple(m) for m in done['moved']}
+    done_dirs    = {tuple(m) for m in done.setdefault('moved_dirs', [])}
+
+    # ------- APPLY DIRECTORY MOVES -------
+    # first: the other operations name paths as they are after these
+    dirs_done = []
+    for old_rel, new_rel in moved_dirs:
+        src_path = norm_path(folder_path, old_rel)
+        dst = norm_path(folder_path, new_rel)
+        if (old_rel, new_rel) in done_dirs:
+            pass
+        elif not os.path.isdir(src_path):
+            if not (journal.resumed and os.path.isdir(dst)):
+                print(f"Warning: source not found for directory move -> {old_rel}", file=sys.stderr)
+                continue
+        else:
+            move_dir(src_path, dst)
+            print(f"Moved directory -> {old_rel} → {new_rel}")
+            done['moved_dirs'].append([old_rel, new_rel])
+            journal.checkpoint()
+        dirs_done.append((old_rel, new_rel))
+        if signatures is not None:
+            prefix = old_rel + os.sep
+            for rel in [rel for rel in signatures if rel.startswith(prefix)]:
+                signatures[new_rel + rel[len(old_rel):]] = signatures.pop(rel)
+
+    # ------- APPLY FILE DELETIONS -------
+    for rel in deleted:
+        if signatures is not None:
+            signatures.pop(rel, None)
+        if rel in done_deleted:
+            continue
+        tgt = norm_path(folder_path, rel)
+        if os.path.isdir(tgt):
+            shutil.rmtree(tgt)
+            print(f"Deleted directory -> {rel}")
+        elif os.path.isfile(tgt):
+            os.remove(tgt)
+            print(f"Deleted file -> {rel}")
+        elif not journal.resumed:
+            print(f"Warning: target not found for delete -> {rel}", file=sys.stderr)
+        done['deleted'].append(rel)
+        journal.checkpoint()
+
+    # ------- APPLY MOVES -------
+    moves_done = []
+    for old_rel, new_rel in moved:
+        src_path = norm_path(folder_path, old_rel)
+        dst = norm_path(folder_path, new_rel)
+        if (old_rel, new_rel) in done_moved:
+            pass
+        elif not os.path.exists(src_path):
+            if not (journal.resumed and os.path.exists(dst)):
+                print(f"Warning: source not found for move -> {old_rel}", file=sys.stderr)
+                continue
+        else:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.move(src_path, dst)
+            print(f"Moved -> {old_rel} → {new_rel}")
+            done['moved'].append([old_rel, new_rel])
+            journal.checkpoint()
+        moves_done.append((old_rel, new_rel))
+        if signatures is not None and old_rel in signatures:
+            signatures[new_rel] = signatures.pop(old_rel)
+
+    # ------- APPLY EMPTY-DIR DELETIONS -------
+    if not done['deleted_dirs']:
+        for rel in deleted_dirs:
+            dir_path = norm_path(folder_path, rel)
+            try:
+                os.removedirs(dir_path)
+                print(f"Deleted empty directory -> {rel}")
+            except OSError:
+                # either not empty or doesn't exist
+                pass
+        done['deleted_dirs'] = True
+        journal.checkpoint()
+    stats.lap('deletes & moves')
+
+    # ------- APPLY ADDITIONS & MODIFICATIONS -------
+    # files are independent of each other, so they are decrypted on a worker pool
+    def apply_one(rel, is_add):
+        if not is_add and rel in deltas:
+            result = apply_delta_update(folder_path, sync_dir, rel, deltas[rel], private_key_path,
+                                        session_keys, signatures, sender_hash)
+            if result == CONFLICT:
+                print(f"Conflict: {rel} changed here since the sender's version; kept ours, "
+                      "it goes out with our next push", file=sys.stderr)
+                return CONFLICT
+            print(f"Updated (delta) -> {rel}")
+            return deltas[rel]['hash'] if trust_hashes else None
+
+        # a missing blob fails the entry: it is retried, not skipped, on the next pull
+        enc_src = staged_path(sync_dir, blobs, rel)
+        if not os.path.isfile(enc_src):
+            raise FileNotFoundError(f"encrypted source not found for {'add' if is_add else 'update'}")
+
+        apply_content(folder_path, rel, enc_src, private_key_path, session_keys)
+        print(f"Added -> {rel}" if is_add else f"Updated -> {rel}")
+        record_signature(signatures, folder_path, rel, blobs.get(rel), delta_min_size, delta_block_size)
+        return blobs.get(rel) if trust_hashes else None  # blob ids are content hashes
+
+    tasks = {rel: True for rel in added}
+    tasks.update((rel, False) for rel in modified if rel not in tasks)
+    failed = []
+    conflicts = []
+    applied = {}  # rel -> content hash
+
+    # files already in place from an interrupted run are not decrypted again
+    for rel, file_hash in done['contents'].items():
+        if tasks.pop(rel, None) is None:
+            continue
+        applied[rel] = file_hash
+        if rel in deltas:
+            record_signature(signatures, folder_path, rel, deltas[rel]['hash'],
+                             delta_min_size, deltas[rel]['block_size'])
+        else:
+            record_signature(signatures, folder_path, rel, blobs.get(rel),
+                             delta_min_size, delta_block_size)
+    if done['contents']:
+        print(f"Resumed: {len(done['contents'])} file(s) already applied")
+
+    # each file is journaled by the worker that applied it, so whatever finishes
+    # after an interrupt is on record too
+    lock = threading.Lock()
+
+    def apply_and_record(rel, is_add):
+        result = apply_one(rel, is_add)
+        if result != CONFLICT:
+            with lock:
+                done['contents'][rel] = result
+                journal.checkpoint()
+        return result
+
+    pool = ThreadPoolExecutor(max_workers=max(1, apply_workers))
+    try:
+        futures = {pool.submit(apply_and_record, rel, is_add): rel
+                   for rel, is_add in tasks.items()}
+        for fut in as_completed(futures):
+            try:
+                result = fut.result()
+                if result == CONFLICT:
+                    conflicts.append(futures[fut])
+                else:
+                    applied[futures[fut]] = result
+            except (OSError, ValueError) as e:
+                print(f"Error: could not apply -> {futures[fut]}: {e}", file=sys.stderr)
+                failed.append(futures[fut])
+    finally:
+        # on an interrupt, files not started yet are dropped; the ones in flight finish
+        pool.shutdown(cancel_futures=True)
+    stats.lap('decrypt & apply')
+    return dirs_done, moves_done, deleted, applied, failed, conflicts
+
+
+def run_pull(settings, verify=False):
     # ------- LOAD SETTINGS -------
-    settings = load_json(args.settings)
-    pc_number            = int(settings.get('pc_number'))
     folder_path          = settings.get('folder_path')
     metadata_path        = settings.get('folder_metadata_path')
-    updates_path         = settings.get(f"folder_pc_{'1' if pc_number == 2 else '2'}_updates_path")
-    sync_dir             = settings.get(f"files_to_sync_from_pc_{'1' if pc_number == 2 else '2'}")
     git_cfg              = settings.get('git', {})
     private_key_path     = settings.get('private_key_path')
+    hash_workers         = int(settings.get('hash_workers', 1))
+    signatures_path      = settings.get('signatures_path')
+    delta_min_size       = int(settings.get('delta_min_size', MIN_SIZE))
+    delta_block_size     = int(settings.get('delta_block_size', BLOCK_SIZE))
+    metadata_backend     = settings.get('metadata_backend', 'json')
+    apply_workers        = int(settings.get('apply_workers', os.cpu_count() or 1))
+    journal_path         = settings.get('pull_journal_path')
+    ignore               = load_ignore(settings)
 
     # ------- VALIDATE -------
-    if not all([folder_path, metadata_path, updates_path, sync_dir, private_key_path]):
+    try:
+        me, peers = load_peers(settings)
+    except (KeyError, ValueError) as e:
+        print(f"Error: bad peer settings: {e}", file=sys.stderr)
+        sys.exit(1)
+    if not all([folder_path, metadata_path, private_key_path]):
         print("Error: settings.json missing required values.", file=sys.stderr)
         sys.exit(1)
+    if git_cfg.get('transport', 'full') not in GIT_TRANSPORTS:
+        print(f"Error: unknown git transport: {git_cfg.get('transport')}", file=sys.stderr)
+        sys.exit(1)
     if not os.path.isdir(folder_path):
         print(f"Error: folder not found: {folder_path}", file=sys.stderr); sys.exit(1)
-    if not os.path.isfile(metadata_path):
+    if not metadata_exists(metadata_path, metadata_backend):
         print(f"Error: metadata file not found: {metadata_path}", file=sys.stderr); sys.exit(1)
+    if not journal_path:
+        journal_path = os.path.join(os.path.dirname(os.path.abspath(metadata_path)),
+                                    'pull-journal.json')
 
     # ------- GIT PULL -------
     repo_path = git_cfg.get('repo_path')
     remote    = git_cfg.get('remote')
     branch    = git_cfg.get('branch', 'main')
     token     = git_cfg.get('token')
+    sparse    = git_cfg.get('transport', 'full') == 'sparse'
 
     if repo_path and remote and token:
-        pull_url = remote
-        if remote.startswith('https://'):
-            pull_url = remote.replace('https://', f'https://{token}@')
         try:
-            subprocess.run(['git','remote','set-url','origin',pull_url], cwd=repo_path, check=True)
-            subprocess.run(['git','pull','origin',branch], cwd=repo_path, check=True)
+            subprocess.run(['git','remote','set-url','origin',authed_url(remote, token)],
+                           cwd=repo_path, check=True)
+            if sparse:
+                set_sparse(repo_path, sparse_dirs(peers, repo_path))
+            result = pull_remote(repo_path, branch, sparse=sparse, own=own_paths(peers, me))
+            if result == 'reset':
+                print(f"Remote history was compacted; followed the new history of {remote}/{branch}")
+            elif result == 'replay':
+                print(f"Remote history was compacted; replayed our unpushed changes onto the new "
+                      f"history of {remote}/{branch}")
             print(f"Pulled latest changes from {remote}/{branch}")
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, RuntimeError) as e:
             print(f"Error during git pull: {e}", file=sys.stderr)
             sys.exit(1)
     else:
         print("Error: incomplete git config, skip pull.", file=sys.stderr)
         sys.exit(1)
+    stats.lap('git pull')
 
     # ------- LOAD UPDATES -------
-    updates = load_json(updates_path) or {}
-    added        = updates.get('added', [])
-    deleted      = updates.get('deleted', [])
-    modified     = updates.get('modified', [])
-    moved        = updates.get('moved', [])          # list of [old_rel, new_rel]
-    deleted_dirs = updates.get('deleted_dirs', [])
-
-    if not (added or deleted or modified or moved or deleted_dirs):
+    # the entries of every other peer's log we have not applied yet, in apply order
+    cursors = load_cursors(peers, me)
+    entries = pending_entries(peers, me, cursors)
+    if not entries:
         print("No updates.")
         return
 
-    # ------- APPLY FILE DELETIONS -------
-    for rel in deleted:
-        tgt = norm_path(folder_path, rel)
-        if os.path.isdir(tgt):
-            shutil.rmtree(tgt)
-            print(f"Deleted directory -> {rel}")
-        elif os.path.isfile(tgt):
-            os.remove(tgt)
-            print(f"Deleted file -> {rel}")
-        else:
-            print(f"Warning: target not found for delete -> {rel}", file=sys.stderr)
-
-    # ------- APPLY MOVES -------
-    for old_rel, new_rel in moved:
-        src = norm_path(folder_path, old_rel)
-        dst = norm_path(folder_path, new_rel)
-        if not os.path.exists(src):
-            print(f"Warning: source not found for move -> {old_rel}", file=sys.stderr)
-            continue
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        shutil.move(src, dst)
-        print(f"Moved -> {old_rel} → {new_rel}")
+    old_meta = load_metadata(metadata_path, metadata_backend)
+    new_meta = old_meta
 
-    # ------- APPLY EMPTY-DIR DELETIONS -------
-    for rel in deleted_dirs:
-        dir_path = norm_path(folder_path, rel)
-        try:
-            os.removedirs(dir_path)
-            print(f"Deleted empty directory -> {rel}")
-        except OSError:
-            # either not empty or doesn't exist
-            pass
-
-    # ------- APPLY ADDITIONS -------
-    for rel in added:
-        enc_src = norm_path(sync_dir, rel + '.enc')
-        if not os.path.isfile(enc_src):
-            print(f"Error: encrypted source not found for add -> {rel}", file=sys.stderr)
-            continue
+    # block signatures of the versions both sides have, for deltas the other way
+    signatures = None
+    if signatures_path:
+        signatures = load_json(signatures_path) or {}
+    session_keys = {}  # peer -> session keys of its staged blobs (one RSA decrypt each)
+    journal = _ApplyJournal(journal_path, cursors)
+    if journal.resumed:
+        print(f"Resuming an interrupted pull from {journal_path}")
 
-        dec_path = decrypt_file(enc_src, private_key_path)
-        dst = norm_path(folder_path, rel)
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        shutil.move(dec_path, dst)
-        print(f"Added -> {rel}")
+    # consecutive entries of one peer are applied as their net effect: nothing is
+    # decrypted only to be replaced or deleted, and files move straight to where
+    # they ended up. a run an interrupted pull was applying stays the same run
+    n_pending = len(entries)
+    entries = coalesce_pending(entries, boundaries=set(journal.entries))
+    if len(entries) < n_pending:
+        print(f"Coalesced {n_pending} pending entries into {len(entries)}")
+    stats.lap('load updates')
 
-    # ------- APPLY MODIFICATIONS -------
-    for rel in modified:
-        enc_src = norm_path(sync_dir, rel + '.enc')
-        if not os.path.isfile(enc_src):
-            print(f"Warning: encrypted source missing for update -> {rel}", file=sys.stderr)
-            continue
+    # ------- APPLY ENTRIES -------
+    failed = []
+    try:
+        for src, entry in entries:
+            sync_dir = peers[src]['staging']
+            n_ops = sum(len(entry.get(op, [])) for op in OPS)
+            covers = entry.get('covers', entry['seq'])
+            seqs = f"#{covers}-{entry['seq']}" if covers != entry['seq'] else f"#{entry['seq']}"
+            print(f"Applying {src} {seqs} ({n_ops} operation(s))")
+            if src not in session_keys:
+                manifest_path = os.path.join(sync_dir, SESSION_MANIFEST)
+                session_keys[src] = {}
+                if os.path.isfile(manifest_path):
+                    session_keys[src] = load_session_keys(manifest_path, private_key_path)
 
-        dec_path = decrypt_file(enc_src, private_key_path)
-        dst = norm_path(folder_path, rel)
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-        shutil.move(dec_path, dst)
-        print(f"Updated -> {rel}")
+            # the sender's hashes go straight into our metadata when both use the same
+            # algorithm; otherwise applied files are hashed here
+            trust_hashes = entry.get('hash_algorithm', DEFAULT_HASH) == hash_algorithm(old_meta)
+            dirs_done, moves_done, deletes_done, applied, failed, conflicts = apply_entry(
+                folder_path, entry, sync_dir, private_key_path, session_keys[src], signatures,
+                trust_hashes, delta_min_size, delta_block_size, apply_workers, journal, src,
+                ignore
+            )
+            if failed:
+                break
+            new_meta = update_metadata(new_meta, folder_path, deletes_done, moves_done,
+                                       entry.get('deleted_dirs', []), applied, dirs_done)
+            # a conflicted file counts as new to our next push, which then sends our
+            # copy whole (or its deletion, if it is gone here)
+            for rel in conflicts:
+                if os.path.isfile(norm_path(folder_path, rel)):
+                    new_meta['files'].pop(rel, None)
+            cursors[src] = entry['seq']
+    finally:
+        # an interruption keeps the journal; the next pull skips what it has as done
+        journal.save()
 
-    # ------- REFRESH METADATA -------
-    old_meta = load_json(metadata_path)
-    scan = scan_folder(folder_path, old_meta=old_meta)
-    new_meta = {
-        'generated_at': time.time(),
-        'files': scan['files'],
-        'dirs':  sorted(scan['dirs'])
-    }
-    save_json(metadata_path, new_meta)
+    # ------- UPDATE METADATA -------
+    if verify and not failed:
+        scan = verify_metadata(new_meta, folder_path, workers=hash_workers, ignore=ignore)
+        new_meta = {
+            'generated_at': time.time(),
+            'hash_algorithm': hash_algorithm(old_meta),
+            'files': scan['files'],
+            'dirs':  sorted(scan['dirs']),
+            'dir_mtimes': scan['dir_mtimes'],
+        }
+    # entries applied before a failure are kept; the failed one is retried next pull
+    if new_meta is not old_meta:
+        save_metadata(metadata_path, new_meta, metadata_backend, previous=old_meta)
+    if signatures is not None:
+        save_json(signatures_path, signatures)
+    save_cursors(peers, me, cursors)
+    stats.lap('metadata')
 
-    # ------- CLEAR UPDATES -------
-    cleared = {
-        'generated_at': time.time(),
-        'added':        [],
-        'deleted':      [],
-        'modified':     [],
-        'moved':        [],
-        'deleted_dirs': []
-    }
-    save_json(updates_path, cleared)
-
-    # ------- CLEAN SYNC FOLDER -------
-    # remove any leftover .enc and decrypted files
-    for rel in added + modified:
-        enc = norm_path(sync_dir, rel + '.enc')
-        if os.path.isfile(enc):
-            os.remove(enc)
-        dec = norm_path(sync_dir, rel)
-        if os.path.isfile(dec):
-            os.remove(dec)
-        # try to remove empty parent dirs
-        parent = os.path.dirname(enc)
-        try:
-            os.removedirs(parent)
-        except OSError:
-            pass
+    if failed:
+        print(f"Error: {len(failed)} file(s) could not be applied.", file=sys.stderr)
+        sys.exit(1)
+    journal.clear()
 
     # ------- GIT COMMIT & PUSH -------
+    # only our cursors change: the senders drop what everyone has applied on their next push
     try:
-        subprocess.run(['git', 'add', '.'], cwd=repo_path, check=True)
-        msg = f"PC{pc_number} folder-sync: {time.strftime('%Y-%m-%d %H:%M:%S')}"
-        subprocess.run(['git','commit','-m', msg], cwd=repo_path, check=True)
-        subprocess.run(['git','push','origin', branch], cwd=repo_path, check=True)
+        msg = f"{me} folder-sync: {time.strftime('%Y-%m-%d %H:%M:%S')}"
+        commit_paths(repo_path, [peers[me]['cursors']], msg)
+        push_branch(repo_path, branch, sparse=sparse, own=own_paths(peers, me))
         print(f"Pushed changes to {remote} ({branch})")
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, RuntimeError) as e:
         print(f"Warning: git push failed: {e}", file=sys.stderr)
+    stats.lap('git push')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sync folder with other device. Pull method (decrypts incoming files)."
+    )
+    parser.add_argument('-s', '--settings', required=True, help="path to settings JSON")
+    parser.add_argument('--verify', action='store_true',
+                        help="check the updated metadata against a full rescan")
+    stats.add_arguments(parser)
+    args = parser.parse_args()
+    stats.run(args, run_pull, load_json(args.settings), verify=args.verify)
 
 
 if __name__ == '__main__':
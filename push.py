@@ -2,161 +2,610 @@ import os
 import time
 import argparse
 import sys
-import shutil
 import subprocess
-from utils import scan_folder, save_json, load_json, norm_path
-from crypto_utils import encrypt_file
+import tempfile
+import bisect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import stats
+from utils import (scan_folder, rescan_paths, save_json, load_json, norm_path, blob_path,
+                   hash_algorithm, inode_index, temp_path, HASH_ALGORITHMS, DEFAULT_HASH)
+from crypto_utils import encrypt_file, new_session, save_session, prune_sessions, SESSION_MANIFEST
+from delta import make_delta, file_signature, BLOCK_SIZE, MIN_SIZE
+from metadata_store import load_metadata, save_metadata, metadata_exists
+from peers import (load_peers, recipients, load_log, save_log, load_cursors, applied_everywhere,
+                   published_seq, coalesce, sparse_dirs, own_paths, legacy_staged, OPS)
+from git_utils import (authed_url, push_branch, pull_remote, rev_parse, set_sparse, tracked_files,
+                       commit_paths, GIT_TRANSPORTS)
+from ignore import load_ignore, ignored_path
 
 
-def compare_metadata(old_meta, new_meta):
-    old_files = set(old_meta['files'])
-    new_files = set(new_meta['files'])
+def compare_metadata(old_meta, new_meta, ignore=None):
+    old_files = old_meta['files']
+    new_files = new_meta['files']
+    old_dirs = set(old_meta['dirs'])
+
+    # what the ignore rules cover now is left alone, not deleted: new_meta comes from
+    # a scan that skipped it, but old_meta may be from before a rule was added
+    if ignore:
+        old_files = {f: e for f, e in old_files.items() if not ignored_path(ignore, f)}
+        old_dirs = {d for d in old_dirs if not (d and ignored_path(ignore, d, True))}
+
+    added   = new_files.keys() - old_files.keys()
+    deleted = old_files.keys() - new_files.keys()
 
-    added   = new_files - old_files
-    deleted = old_files - new_files
+    # hashes made with different algorithms say nothing about each other (the first
+    # push after changing hash_algorithm): fall back to size and mtime, no move detection
+    same_hashes = hash_algorithm(old_meta) == hash_algorithm(new_meta)
 
     # modified = files present in both but with different hashes
-    modified = [
-        f for f in (old_files & new_files)
-        if old_meta['files'][f]['hash'] != new_meta['files'][f]['hash']
-    ]
+    if same_hashes:
+        modified = [
+            f for f in (old_files.keys() & new_files.keys())
+            if old_files[f]['hash'] != new_files[f]['hash']
+        ]
+    else:
+        modified = [
+            f for f in (old_files.keys() & new_files.keys())
+            if (old_files[f]['size'], old_files[f]['mtime'])
+            != (new_files[f]['size'], new_files[f]['mtime'])
+        ]
+
+    # detect directory moves: a directory that is gone, whose files mostly turn up
+    # with the same content at the same relative paths under one new directory, is
+    # moved as a whole. its other files are then seen at their new place: one that
+    # changed is modified there, one that went elsewhere is moved from there, one
+    # that is gone is deleted there
+    moved_dirs = []
+    old_view = {f: old_files[f] for f in deleted}  # deleted paths as pull will see them
+    old_dirs_view = old_dirs
+    gone = old_dirs - set(new_meta['dirs'])
+    if same_hashes and gone and added and old_files and 'hash' in next(iter(old_files.values())):
+        added_by_hash = {}
+        for f in added:
+            added_by_hash.setdefault(new_files[f]['hash'], []).append(f)
+        new_dirs = set(new_meta['dirs'])
+
+        votes = {}  # gone dir -> {candidate new dir: files found there}
+        counts = {}  # gone dir -> files under it
+        for f in deleted:
+            d = os.path.dirname(f)
+            while d in gone and d:
+                counts[d] = counts.get(d, 0) + 1
+                rest = f[len(d):]
+                for n in added_by_hash.get(old_files[f]['hash'], ())[:8]:
+                    if n.endswith(rest):
+                        target = n[:-len(rest)]
+                        if target in new_dirs and target not in old_dirs:
+                            cands = votes.setdefault(d, {})
+                            cands[target] = cands.get(target, 0) + 1
+                d = os.path.dirname(d)
+
+        def ancestors(path):
+            path = os.path.dirname(path)
+            while path:
+                yield path
+                path = os.path.dirname(path)
 
-    # detect moved via hash matching
+        # parents come first, so a moved directory's subdirectories are skipped.
+        # overlaps are looked up by walking up the paths, not by scanning the moves
+        taken = {}           # moved dir -> its new place
+        targets = set()      # new places taken
+        under_targets = set()  # the parents of those
+        for d in sorted(votes, key=lambda d: (d.count(os.sep), d)):
+            if any(a in taken for a in ancestors(d)):
+                continue  # inside a directory already moved
+            target, n = max(votes[d].items(), key=lambda kv: (kv[1], kv[0]))
+            if (n * 2 < counts[d] or target in targets or target in under_targets
+                    or any(a in targets for a in ancestors(target))):
+                continue
+            taken[d] = target
+            targets.add(target)
+            under_targets.update(ancestors(target))
+
+        if taken:
+            moved_dirs = sorted(taken.items())
+
+            def mirror(path):
+                # path (or its closest parent) moved with a directory: where it is now
+                p = path
+                while p:
+                    if p in taken:
+                        return taken[p] + path[len(p):]
+                    p = os.path.dirname(p)
+                return path
+
+            old_view = {}
+            for f in deleted:
+                m = mirror(f)
+                if m != f and m in added:
+                    added.discard(m)
+                    if old_files[f]['hash'] != new_files[m]['hash']:
+                        modified.append(m)
+                else:
+                    old_view[m] = old_files[f]
+            deleted = set(old_view)
+            old_dirs_view = {mirror(d) for d in old_dirs}
+
+    # detect moved via hash matching: only deleted files are indexed, added files
+    # are looked up against it. a file that kept its inode is paired with its own
+    # old path first; the others are paired in sorted order within each hash
     moved = []
-    if old_meta['files'] and 'hash' in next(iter(old_meta['files'].values())):
+    if same_hashes and deleted and added and 'hash' in next(iter(old_view.values())):
+        old_by_inode = inode_index({f: old_view[f] for f in deleted})
+        for new_path in sorted(added):
+            e = new_files[new_path]
+            old_path = old_by_inode.get((e.get('dev'), e.get('ino')))
+            if old_path in deleted and old_view[old_path]['hash'] == e['hash']:
+                moved.append((old_path, new_path))
+                deleted.remove(old_path)
+                added.remove(new_path)
+
         old_by_hash = {}
-        for f in deleted:
-            h = old_meta['files'][f]['hash']
-            old_by_hash.setdefault(h, []).append(f)
+        for f in sorted(deleted, reverse=True):
+            old_by_hash.setdefault(old_view[f]['hash'], []).append(f)
 
-        new_by_hash = {}
-        for f in added:
-            h = new_meta['files'][f]['hash']
-            new_by_hash.setdefault(h, []).append(f)
-
-        for h, olds in old_by_hash.items():
-            if h in new_by_hash:
-                news = new_by_hash[h]
-                for old_path, new_path in zip(sorted(olds), sorted(news)):
-                    moved.append((old_path, new_path))
-                    deleted.remove(old_path)
-                    added.remove(new_path)
-
-    # detect empty-dir deletions
-    old_dirs = set(old_meta['dirs'])
-    new_dirs = set(new_meta['dirs'])
+        for new_path in sorted(added):
+            olds = old_by_hash.get(new_files[new_path]['hash'])
+            if olds:
+                old_path = olds.pop()
+                moved.append((old_path, new_path))
+                deleted.remove(old_path)
+                added.remove(new_path)
+
+    # detect empty-dir deletions: a removed dir is reported when no current file
+    # lives under it, checked by bisecting a sorted list of the current paths
     deleted_dirs = []
-    for d in sorted(old_dirs - new_dirs):
-        prefix = d + os.sep if d else ''
-        if not any(f.startswith(prefix) for f in new_meta['files']):
-            deleted_dirs.append(d or '.')
+    gone_dirs = old_dirs_view - set(new_meta['dirs'])
+    if gone_dirs:
+        paths = sorted(new_files)
+        for d in sorted(gone_dirs):
+            prefix = d + os.sep if d else ''
+            i = bisect.bisect_left(paths, prefix)
+            if i == len(paths) or not paths[i].startswith(prefix):
+                deleted_dirs.append(d or '.')
 
     return {
         "added":        sorted(added),
         "deleted":      sorted(deleted),
         "modified":     sorted(modified),
         "moved":        sorted(moved),
+        "moved_dirs":   moved_dirs,
         "deleted_dirs": deleted_dirs
     }
 
 
-def copy_and_encrypt_files(folder_path, files, dest_dir, public_key_path):
-    if os.path.exists(dest_dir):
-        shutil.rmtree(dest_dir)
+def encrypt_blob(src, dst, public_key_path, session=None, codec=None):
+    # encrypt next to dst and rename it into place: a blob at its final path is always
+    # complete, so one cut short by a killed push is never taken as already staged
+    tmp = temp_path(dst)
+    try:
+        encrypt_file(src, public_key_path, output_file=tmp, session=session, codec=codec)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(tmp, dst)
+
+
+def stage_blobs(folder_path, files, blobs, dest_dir, public_key_path, session=None,
+                workers=1, keep=(), codec=None, keep_paths=()):
+    # dest_dir ends up holding exactly one encrypted blob per content hash in blobs:
+    # blobs staged by an earlier push are kept, missing ones are encrypted from any
+    # current file with that hash, and blobs nobody refers to are removed.
+    # keep_paths: staged files outside that layout that are still pending
     os.makedirs(dest_dir, exist_ok=True)
+    needed = set(blobs.values()) | set(keep)
+    missing = {h for h in needed if not os.path.isfile(blob_path(dest_dir, h))}
+
+    # any file with the right content will do as the source
+    sources = {}
+    for rel, entry in files.items():
+        h = entry.get('hash')
+        if h in missing and h not in sources:
+            sources[h] = rel
+    for h in missing - set(sources):
+        print(f"Warning: no source left for pending blob -> {h}", file=sys.stderr)
 
-    for rel in files:
+    if session and sources:
+        save_session(os.path.join(dest_dir, SESSION_MANIFEST), session)
+
+    # encrypt straight from the source into the staging dir:
+    # no plaintext copy ever lands in the repo
+    def encrypt_one(item):
+        h, rel = item
         src = norm_path(folder_path, rel)
-        dst = norm_path(dest_dir, rel)
+        dst = blob_path(dest_dir, h)
         os.makedirs(os.path.dirname(dst), exist_ok=True)
-
         try:
-            shutil.copy2(src, dst)
+            size = os.path.getsize(src)
+            encrypt_blob(src, dst, public_key_path, session=session, codec=codec)
         except FileNotFoundError:
-            print(f"Warning: source not found for copy -> {rel}", file=sys.stderr)
+            print(f"Warning: source not found for encrypt -> {rel}", file=sys.stderr)
+            return 0
+        return size
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        total_bytes = sum(pool.map(encrypt_one, sources.items()))
+    elapsed = time.time() - start
+
+    # drop stale blobs (and anything left in the old per-path layout no pending
+    # entry needs), and the half-written ones of a push that was killed
+    keep_paths = {os.path.abspath(p) for p in keep_paths}
+    for root, dirs, names in os.walk(dest_dir, topdown=False):
+        for fn in names:
+            path = os.path.join(root, fn)
+            if os.path.abspath(path) in keep_paths:
+                continue
+            if fn.endswith('.fsync-tmp') or (
+                    fn.endswith('.enc') and (fn[:-4] not in needed
+                                             or path != blob_path(dest_dir, fn[:-4]))):
+                os.remove(path)
+        if root != dest_dir:
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+
+    return len(sources), total_bytes, elapsed
+
+
+def stage_deltas(folder_path, modified, files, signatures, dest_dir, public_key_path,
+                 session=None, min_size=MIN_SIZE, codec=None):
+    # for large modified files whose version on the other side is known, stage an
+    # encrypted delta against that version instead of the whole file.
+    # returns rel -> {'base', 'hash', 'block_size', 'blob'}
+    deltas = {}
+    for rel in modified:
+        entry = files[rel]
+        # peers apply our entries in order: by the time they get to this one they
+        # have the version we pushed last, or the synced one if nothing is pending
+        sigs = signatures.get(rel, {})
+        base = sigs.get('pushed') or sigs.get('synced')
+        if entry['size'] < min_size or not base:
             continue
 
-        encrypt_file(dst, public_key_path)
-        os.remove(dst)
+        fd, tmp = tempfile.mkstemp(suffix='.delta')
+        os.close(fd)
+        try:
+            delta_size, sig = make_delta(norm_path(folder_path, rel), entry['hash'], base, tmp)
+            signatures[rel]['pushed'] = sig
+            if delta_size >= entry['size']:
+                continue  # not smaller: ship the whole file
 
+            blob_id = f"{entry['hash']}-{base['hash']}"
+            dst = blob_path(dest_dir, blob_id)
+            if not os.path.isfile(dst):
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if session:
+                    save_session(os.path.join(dest_dir, SESSION_MANIFEST), session)
+                encrypt_blob(tmp, dst, public_key_path, session=session, codec=codec)
+            deltas[rel] = {
+                'base': base['hash'],
+                'hash': entry['hash'],
+                'block_size': base['block_size'],
+                'blob': blob_id,
+            }
+        finally:
+            os.remove(tmp)
+    return deltas
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Scan a folder, record updates (incl. moves & empty-dir deletes), "
-                    "stage content changes (encrypted), and push to git."
-    )
-    parser.add_argument('-s', '--settings', required=True, help="Path to settings JSON")
-    args = parser.parse_args()
+
+class _EarlyStager:
+    # encrypts the blobs of new content while the scan is still running: a file
+    # hashed to content the old metadata never had is an add or a modify, so its
+    # blob is needed whatever the diff says. at most `window` encryptions are in
+    # flight; past that the scan waits. stage_blobs later finds these in place and
+    # only encrypts what is left (copies, retries)
+    def __init__(self, folder_path, dest_dir, public_key_path, known_hashes, skip=None,
+                 use_session=False, workers=1, codec=None):
+        self.folder_path = folder_path
+        self.dest_dir = dest_dir
+        self.public_key_path = public_key_path
+        self.known = known_hashes
+        self.skip = skip
+        self.use_session = use_session
+        self.codec = codec
+        self.session = None
+        self.started = set()
+        self.total_bytes = 0
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.slots = threading.BoundedSemaphore(max(1, workers) * 2)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.start = None
+
+    def __call__(self, rel, entry):
+        h = entry['hash']
+        if h in self.known or h in self.started or (self.skip and self.skip(rel, entry)):
+            return
+        self.started.add(h)
+        dst = blob_path(self.dest_dir, h)
+        if os.path.isfile(dst):
+            return
+        if self.start is None:
+            self.start = time.time()
+            os.makedirs(self.dest_dir, exist_ok=True)
+            if self.use_session:
+                # one RSA wrap per recipient for the whole push instead of per file
+                self.session = new_session(self.public_key_path)
+                save_session(os.path.join(self.dest_dir, SESSION_MANIFEST), self.session)
+        self.slots.acquire()
+        fut = self.pool.submit(self._encrypt, rel, dst)
+        fut.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(fut)
+
+    def _encrypt(self, rel, dst):
+        src = norm_path(self.folder_path, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            size = os.path.getsize(src)
+            encrypt_blob(src, dst, self.public_key_path, session=self.session,
+                         codec=self.codec)
+        except FileNotFoundError:
+            return  # gone since the hash; stage_blobs sorts it out
+        with self.lock:
+            self.total_bytes += size
+
+    def finish(self):
+        # -> (blobs encrypted, bytes, seconds)
+        try:
+            for fut in self.futures:
+                fut.result()
+        finally:
+            self.pool.shutdown()
+        elapsed = time.time() - self.start if self.start else 0.0
+        stats.count('blobs_encrypted_during_scan', len(self.futures))
+        return len(self.futures), self.total_bytes, elapsed
+
+
+def run_push(cfg, touched=None):
+    # touched: relative paths known to have changed (from watch.py's journal); when
+    # given only those are rescanned, otherwise the whole folder is
 
     # --- LOAD SETTINGS ---
-    cfg = load_json(args.settings)
-    pc_number        = int(cfg['pc_number'])
     folder_path      = cfg['folder_path']
     metadata_path    = cfg['folder_metadata_path']
-    updates_path     = cfg[f'folder_pc_{pc_number}_updates_path']
-    files_to_sync_dir= cfg[f'files_to_sync_from_pc_{pc_number}']
     git_cfg          = cfg['git']
-    public_key_path  = cfg['public_key_path']
+    hash_workers     = int(cfg.get('hash_workers', 1))
+    prune_dirs       = bool(cfg.get('prune_unchanged_dirs', False))
+    use_session      = bool(cfg.get('session_keys', False))
+    encrypt_workers  = int(cfg.get('encrypt_workers', os.cpu_count() or 1))
+    signatures_path  = cfg.get('signatures_path')
+    delta_min_size   = int(cfg.get('delta_min_size', MIN_SIZE))
+    delta_block_size = int(cfg.get('delta_block_size', BLOCK_SIZE))
+    compression      = cfg.get('compression')
+    metadata_backend = cfg.get('metadata_backend', 'json')
+    algorithm        = cfg.get('hash_algorithm', DEFAULT_HASH)
+    ignore           = load_ignore(cfg)
+    transport        = (git_cfg or {}).get('transport', 'full')
 
     # --- VALIDATE ---
-    for p in (folder_path, metadata_path, updates_path, files_to_sync_dir, public_key_path):
+    try:
+        me, peers = load_peers(cfg)
+    except (KeyError, ValueError) as e:
+        print(f"Error: bad peer settings: {e}", file=sys.stderr)
+        sys.exit(1)
+    log_path          = peers[me]['log']
+    files_to_sync_dir = peers[me]['staging']
+    public_keys       = recipients(peers, me)
+    for p in (folder_path, metadata_path):
         if not p:
             print("Error: settings.json missing a required key.", file=sys.stderr)
             sys.exit(1)
     if not os.path.isdir(folder_path):
         print(f"Error: folder not found: {folder_path}", file=sys.stderr); sys.exit(1)
-    if not os.path.isfile(metadata_path):
+    if not metadata_exists(metadata_path, metadata_backend):
         print(f"Error: metadata file not found: {metadata_path}", file=sys.stderr); sys.exit(1)
+    if algorithm not in HASH_ALGORITHMS:
+        print(f"Error: unknown hash_algorithm: {algorithm}", file=sys.stderr); sys.exit(1)
+    if transport not in GIT_TRANSPORTS:
+        print(f"Error: unknown git transport: {transport}", file=sys.stderr); sys.exit(1)
 
 
     # --- LOAD OLD META & SCAN NEW ---
-    old_meta = load_json(metadata_path)
-    scan = scan_folder(folder_path, old_meta=old_meta)
+    old_meta = load_metadata(metadata_path, metadata_backend)
+    stats.lap('load metadata')
+    if hash_algorithm(old_meta) != algorithm:
+        print(f"Hash algorithm changed ({hash_algorithm(old_meta)} -> {algorithm}): "
+              "rehashing the whole folder")
+    # new content is encrypted as the scan finds it. large files of known paths may
+    # go as deltas, which only the diff can tell, so they wait for stage_blobs.
+    # after a hash algorithm change every hash is new and the diff decides alone
+    early = None
+    if hash_algorithm(old_meta) == algorithm:
+        old_files = old_meta['files']
+        early = _EarlyStager(
+            folder_path, files_to_sync_dir, public_keys,
+            {e.get('hash') for e in old_files.values()},
+            skip=lambda rel, e: bool(signatures_path) and rel in old_files
+                                and e['size'] >= delta_min_size,
+            use_session=use_session, workers=encrypt_workers, codec=compression
+        )
+    try:
+        if touched is None:
+            scan = scan_folder(folder_path, old_meta=old_meta, workers=hash_workers,
+                               prune_unchanged_dirs=prune_dirs, algorithm=algorithm,
+                               on_hashed=early, ignore=ignore)
+        else:
+            scan = rescan_paths(folder_path, old_meta, touched, workers=hash_workers,
+                                algorithm=algorithm, on_hashed=early, ignore=ignore)
+    finally:
+        early_new, early_bytes, early_elapsed = early.finish() if early else (0, 0, 0.0)
     new_meta = {
         'generated_at': time.time(),
+        'hash_algorithm': algorithm,
         'files': scan['files'],
         'dirs':  scan['dirs'],
+        'dir_mtimes': scan['dir_mtimes'],
     }
+    stats.lap('scan')
 
     # --- DIFF ---
-    diff = compare_metadata(old_meta, new_meta)
+    diff = compare_metadata(old_meta, new_meta, ignore)
+    stats.lap('diff')
     added        = diff['added']
     deleted      = diff['deleted']
     modified     = diff['modified']
     moved        = [list(m) for m in diff['moved']]  # Convert tuples to lists
+    moved_dirs   = [list(m) for m in diff['moved_dirs']]
     deleted_dirs = diff['deleted_dirs']
+    changed      = bool(added or deleted or modified or moved or moved_dirs or deleted_dirs)
 
-    # --- MERGE INTO PENDING UPDATES JSON ---
-    if os.path.isfile(updates_path):
-        existing = load_json(updates_path)
-    else:
-        existing = {'added':[], 'deleted':[], 'modified':[], 'moved':[], 'deleted_dirs':[]}
+    # --- UPDATE OUR LOG ---
+    # entries every other peer has applied are dropped; what is left is still pending
+    log = load_log(log_path)
+    done = applied_everywhere(peers, me)
+    n_before = len(log['entries'])
+    log['entries'] = [e for e in log['entries'] if e['seq'] > done]
+    trimmed = n_before - len(log['entries'])
+    pending = set()
+    for e in log['entries']:
+        pending.update(e.get('added', []) + e.get('modified', []))
 
-    merged = {
-        'generated_at': time.time(),
-        'added':         sorted(set(existing.get('added',[])       + added)),
-        'deleted':       sorted(set(existing.get('deleted',[])     + deleted)),
-        'modified':      sorted(set(existing.get('modified',[])    + modified)),
-        'moved':         sorted(set(tuple(x) for x in existing.get('moved',[])) | set(tuple(x) for x in moved)),
-        'deleted_dirs':  sorted(set(existing.get('deleted_dirs',[])+ deleted_dirs)),
+    entry = {
+        'seq':            log.get('last_seq', 0) + 1,
+        'generated_at':   time.time(),
+        'hash_algorithm': algorithm,
+        # what we had applied from the others: the entry goes after those everywhere
+        'seen':           {k: v for k, v in load_cursors(peers, me).items() if k != me},
+        'added':          added,
+        'deleted':        deleted,
+        'modified':       modified,
+        'moved':          moved,
+        # applied before everything else: the other operations name paths
+        # as they are after these
+        'moved_dirs':     moved_dirs,
+        'deleted_dirs':   deleted_dirs,
+        # content to ship: path -> blob id (the content hash)
+        'blobs':          {rel: new_meta['files'][rel]['hash'] for rel in added + modified},
     }
-    # convert moved back to list of lists for JSON compatibility
-    merged['moved'] = [list(x) for x in merged['moved']]
-    save_json(updates_path, merged)
 
-    print(f"Updates recorded -> {updates_path}")
+    # one RSA wrap per recipient for the whole push (the one the scan started, if any)
+    session = early.session if early else None
+    if use_session and not session and (added or modified):
+        session = new_session(public_keys)
+
+    # --- DELTAS FOR LARGE MODIFIED FILES ---
+    # signatures hold, per path, the version every peer has ('synced') and the
+    # last version we pushed ('pushed'). a pushed version is synced once no entry
+    # still pending in our log carries that path
+    signatures = None
+    deltas = {}
+    if signatures_path:
+        signatures = load_json(signatures_path) or {}
+        for rel, sigs in signatures.items():
+            if 'pushed' in sigs and rel not in pending:
+                sigs['synced'] = sigs.pop('pushed')
+        for old_dir, new_dir in moved_dirs:
+            prefix = old_dir + os.sep
+            for rel in [rel for rel in signatures if rel.startswith(prefix)]:
+                signatures[new_dir + rel[len(old_dir):]] = signatures.pop(rel)
+        for old_rel, new_rel in moved:
+            if old_rel in signatures:
+                signatures[new_rel] = signatures.pop(old_rel)
+        for rel in deleted:
+            signatures.pop(rel, None)
+
+        deltas = stage_deltas(
+            folder_path, modified, new_meta['files'], signatures, files_to_sync_dir,
+            public_keys, session=session, min_size=delta_min_size, codec=compression
+        )
+        for rel in deltas:
+            entry['blobs'].pop(rel, None)
+    entry['deltas'] = deltas
+    stats.lap('deltas')
+
+    folded = 0
+    if changed:
+        # entries that never reached the remote (failed or skipped pushes) can't have
+        # been applied anywhere: they are folded into this one, and the blobs only
+        # they needed are dropped with them
+        unpublished = []
+        if git_cfg and git_cfg.get('repo_path') and git_cfg.get('remote'):
+            published = published_seq(git_cfg['repo_path'], git_cfg.get('branch', 'main'),
+                                      log_path)
+            unpublished = [e for e in log['entries'] if e['seq'] > published]
+        net = coalesce(unpublished + [entry]) if unpublished else None
+        if net is not None:
+            folded = len(unpublished)
+            log['entries'] = log['entries'][:-folded]
+            if any(net.get(op) for op in OPS):
+                log['entries'].append(net)
+        else:
+            log['entries'].append(entry)
+        log['last_seq'] = entry['seq']
+    if changed or trimmed or not os.path.isfile(log_path):
+        save_log(log_path, log)
+    stats.lap('save updates')
+
+    print(f"Updates recorded -> {log_path}" if changed else "No changes to record.")
     print(f"  Added:           {len(added)}")
     print(f"  Deleted:         {len(deleted)}")
     print(f"  Modified:        {len(modified)}")
     print(f"  Moved:           {len(moved)}")
+    print(f"  Dirs moved:      {len(moved_dirs)}")
     print(f"  Empty-dirs del:  {len(deleted_dirs)}")
+    if deltas:
+        print(f"  Sent as delta:   {len(deltas)}")
+    if trimmed:
+        print(f"  Applied by all:  {trimmed} older entr{'y' if trimmed == 1 else 'ies'} dropped")
+    if folded:
+        print(f"  Coalesced with:  {folded} unpushed entr{'y' if folded == 1 else 'ies'}")
 
     # --- STAGE & ENCRYPT CONTENT CHANGES ---
-    copy_and_encrypt_files(folder_path, added + modified, files_to_sync_dir, public_key_path)
-    print(f"Staged & encrypted {len(added) + len(modified)} files -> {files_to_sync_dir}")
+    # blobs of older pending entries are already staged and stay; blobs no pending
+    # entry refers to any more are removed
+    keep = [d['blob'] for d in deltas.values()]
+    legacy = []  # files of pending two-machine entries, still staged per path
+    for e in log['entries']:
+        keep.extend(e.get('blobs', {}).values())
+        keep.extend(d['blob'] for d in e.get('deltas', {}).values())
+        legacy.extend(legacy_staged(e, files_to_sync_dir))
+    n_new, total_bytes, elapsed = stage_blobs(
+        folder_path, new_meta['files'], entry['blobs'] if changed else {}, files_to_sync_dir,
+        public_keys, session=session, workers=encrypt_workers, keep=keep, codec=compression,
+        keep_paths=legacy
+    )
+    manifest = os.path.join(files_to_sync_dir, SESSION_MANIFEST)
+    if os.path.isfile(manifest):
+        prune_sessions(manifest, [blob_path(files_to_sync_dir, b) for b in set(keep)
+                                  if os.path.isfile(blob_path(files_to_sync_dir, b))])
+    stats.lap('encrypt')
+    n_new += early_new
+    total_bytes += early_bytes
+    elapsed += early_elapsed
+    mb = total_bytes / (1024 * 1024)
+    rate = mb / elapsed if elapsed > 0 else 0.0
+    print(f"Staged {len(set(keep))} blobs ({n_new} newly encrypted for "
+          f"{len(public_keys)} recipient key(s)) -> {files_to_sync_dir}")
+    print(f"  {mb:.1f} MB in {elapsed:.2f}s ({rate:.1f} MB/s)")
+
+    # signatures of large files shipped whole, for the next delta
+    if signatures is not None:
+        for rel in added + modified:
+            entry_meta = new_meta['files'][rel]
+            if rel in deltas:
+                continue
+            sig = None
+            if entry_meta['size'] >= delta_min_size:
+                try:
+                    sig = file_signature(norm_path(folder_path, rel), entry_meta['hash'],
+                                         delta_block_size)
+                except FileNotFoundError:
+                    pass
+            if sig:
+                signatures.setdefault(rel, {})['pushed'] = sig
+            else:
+                signatures.pop(rel, None)  # no known base for the next delta
+        save_json(signatures_path, signatures)
+        stats.lap('signatures')
 
     # --- GIT PUSH ---
-    if git_cfg and (added or deleted or modified or moved or deleted_dirs):
+    if git_cfg and (changed or trimmed):
         repo_path = git_cfg.get('repo_path')
         remote    = git_cfg.get('remote')
         branch    = git_cfg.get('branch', 'main')
@@ -164,30 +613,59 @@ def main():
         if not all([repo_path, remote, token]):
             print("Warning: incomplete git config, skipping push", file=sys.stderr)
         else:
-            push_url = remote
-            if remote.startswith('https://'):
-                push_url = remote.replace('https://', f'https://{token}@')
             try:
                 subprocess.run(
-                    ['git','remote','set-url','origin',push_url],
+                    ['git','remote','set-url','origin',authed_url(remote, token)],
                     cwd=repo_path, check=True
                 )
-                subprocess.run(
-                    ['git','add', updates_path, files_to_sync_dir],
-                    cwd=repo_path, check=True
-                )
-                msg = f"PC{pc_number} folder-sync: {time.strftime('%Y-%m-%d %H:%M:%S')}"
-                subprocess.run(['git','commit','-m',msg], cwd=repo_path, check=True)
-                subprocess.run(['git','push','origin',branch], cwd=repo_path, check=True)
+                msg = f"{me} folder-sync: {time.strftime('%Y-%m-%d %H:%M:%S')}"
+                if rev_parse(repo_path, 'HEAD') is None:
+                    # a repo started with git init: commit on top of the remote's
+                    # history, not as a new root that could never be pushed
+                    if transport == 'sparse':
+                        set_sparse(repo_path, sparse_dirs(peers, repo_path))
+                    pull_remote(repo_path, branch, sparse=transport == 'sparse',
+                                own=own_paths(peers, me))
+                if transport == 'sparse':
+                    # blobs are content-addressed, so what changed in the staging dir is
+                    # what came or went: the index says what the last commit had
+                    needed = set(keep) | set(entry['blobs'].values() if changed else ())
+                    staged = {os.path.abspath(blob_path(files_to_sync_dir, b)) for b in needed}
+                    staged.update(os.path.abspath(p) for p in legacy if os.path.isfile(p))
+                    staged.add(os.path.abspath(manifest))
+                    tracked = {os.path.abspath(os.path.join(repo_path, p))
+                               for p in tracked_files(repo_path, files_to_sync_dir)}
+                    commit_paths(repo_path, [log_path, manifest, *sorted(staged ^ tracked)], msg)
+                else:
+                    subprocess.run(
+                        ['git','add', log_path, files_to_sync_dir],
+                        cwd=repo_path, check=True
+                    )
+                    subprocess.run(['git','commit','-m',msg], cwd=repo_path, check=True)
+                push_branch(repo_path, branch, sparse=transport == 'sparse',
+                            own=own_paths(peers, me))
                 print(f"Pushed changes to {remote} ({branch})")
-            except subprocess.CalledProcessError as e:
+            except (subprocess.CalledProcessError, RuntimeError) as e:
                 print(f"Warning: git push failed: {e}", file=sys.stderr)
+    stats.lap('git push')
 
     # --- SAVE NEW META ---
     new_meta['dirs'] = sorted(new_meta['dirs'])
-    save_json(metadata_path, new_meta)
+    save_metadata(metadata_path, new_meta, metadata_backend, previous=old_meta)
+    stats.lap('save metadata')
     print(f"Metadata updated -> {metadata_path}")
 
 
+def main():
+    parser = argparse.ArgumentParser(
+        description="Scan a folder, record updates (incl. moves & empty-dir deletes), "
+                    "stage content changes (encrypted), and push to git."
+    )
+    parser.add_argument('-s', '--settings', required=True, help="Path to settings JSON")
+    stats.add_arguments(parser)
+    args = parser.parse_args()
+    stats.run(args, run_push, load_json(args.settings))
+
+
 if __name__ == '__main__':
     main()
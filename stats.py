@@ -0,0 +1,88 @@
+import sys
+import time
+import json
+import cProfile
+import threading
+
+# counters and phase timings of one push or pull, printed with --stats.
+# counters are bumped from worker threads too, so updates take a lock; hot loops
+# should add up locally and call count() once.
+_lock = threading.Lock()
+counters = {}
+phases = {}  # phase name -> seconds, in the order the phases ran
+_lap = [time.perf_counter()]
+
+
+def count(name, n=1):
+    with _lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def lap(name):
+    # time since the previous lap (or start()) goes to phase `name`
+    now = time.perf_counter()
+    with _lock:
+        phases[name] = phases.get(name, 0.0) + now - _lap[0]
+        _lap[0] = now
+
+
+def start():
+    counters.clear()
+    phases.clear()
+    _lap[0] = time.perf_counter()
+
+
+def summary():
+    out = {'phases': dict(phases), 'total_seconds': sum(phases.values()),
+           'counters': dict(counters)}
+    reused = counters.get('hash_reused', 0)
+    hashed = counters.get('files_hashed', 0)
+    if reused + hashed:
+        out['hash_reuse_rate'] = reused / (reused + hashed)
+    return out
+
+
+def report(fmt='text', out=sys.stdout):
+    s = summary()
+    if fmt == 'json':
+        json.dump(s, out, indent=2)
+        out.write("\n")
+        return
+
+    total = s['total_seconds'] or 1.0
+    print("Stats:", file=out)
+    for name, secs in s['phases'].items():
+        print(f"  {name:<22} {secs:9.3f}s  {secs / total * 100:5.1f}%", file=out)
+    print(f"  {'total':<22} {s['total_seconds']:9.3f}s", file=out)
+    for name, value in sorted(s['counters'].items()):
+        if name.endswith('bytes'):
+            print(f"  {name:<22} {value / 1024 / 1024:11.1f} MB", file=out)
+        elif isinstance(value, float):
+            print(f"  {name:<22} {value:11.3f}", file=out)
+        else:
+            print(f"  {name:<22} {value:11d}", file=out)
+    if 'hash_reuse_rate' in s:
+        print(f"  {'hash_reuse_rate':<22} {s['hash_reuse_rate'] * 100:10.1f}%", file=out)
+
+
+def add_arguments(parser):
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help="print per-phase timings and counters at the end (text or json)")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="write a cProfile dump (readable with pstats / snakeviz)")
+
+
+def run(args, fn, *fn_args, **fn_kwargs):
+    # runs fn under the --stats / --profile options parsed by add_arguments
+    start()
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            return profiler.runcall(fn, *fn_args, **fn_kwargs)
+        return fn(*fn_args, **fn_kwargs)
+    finally:
+        if profiler:
+            profiler.dump_stats(args.profile)
+            print(f"Profile written -> {args.profile}", file=sys.stderr)
+        if args.stats:
+            report(args.stats)
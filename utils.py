@@ -1,51 +1,328 @@
 import os
 import json
+import stat
+import time
 import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import stats
+from ignore import ignored_path
 
-def scan_folder(folder_path, compute_hash=True, old_meta=None):
-    meta = {'files': {}, 'dirs': set()}
+# content hashes. metadata records the algorithm it was made with
+# ('hash_algorithm'); metadata without it predates the setting and is sha1
+HASH_ALGORITHMS = ('sha1', 'sha256', 'blake2b', 'blake2s')
+DEFAULT_HASH = 'sha1'
+HASH_READ_SIZE = 1024 * 1024
+_hash_buffers = threading.local()
+# dir mtimes closer to now than this may change again within the same timestamp
+# tick (2s on the coarsest filesystems), so they are not trusted for pruning
+RACY_MTIME = 2.0
 
-    for root, dirs, files in os.walk(folder_path):
-        rel_dir = os.path.relpath(root, folder_path)
-        if rel_dir == '.':
-            rel_dir = ''
+
+def scan_folder(folder_path, compute_hash=True, old_meta=None, workers=1,
+                prune_unchanged_dirs=False, start='', algorithm=DEFAULT_HASH, on_hashed=None,
+                ignore=None):
+    # start: relative dir to scan instead of the whole folder (paths stay relative to folder_path)
+    # on_hashed(rel, entry): called as soon as a file had to be (re)hashed, while the
+    # walk goes on
+    # ignore: matcher from ignore.load_ignore; ignored dirs are not descended into
+    meta = {'files': {}, 'dirs': set(), 'dir_mtimes': {}}
+    if compute_hash and old_meta and hash_algorithm(old_meta) != algorithm:
+        old_meta = None  # hashes made with another algorithm can't be reused
+    old_files = (old_meta or {}).get('files', {})
+
+    # a directory whose mtime is unchanged has the same entries as last time, so its
+    # listing can be taken from old_meta. its files are still statted: in-place edits
+    # do not touch the directory mtime. a listed dir whose mtime is too recent to be
+    # settled gets none recorded, so the next scan lists it again
+    old_dir_mtimes = {}
+    if prune_unchanged_dirs and old_meta:
+        old_dir_mtimes = old_meta.get('dir_mtimes', {})
+    old_children = _index_children(old_meta) if old_dir_mtimes else {}
+    old_inodes = None  # built on the first file the path lookup misses
+
+    # hashing runs on a thread pool while the walk continues
+    # (hashlib releases the GIL on large updates). at most `window` hashes are in
+    # flight; the walk waits for the oldest one beyond that
+    pool = ThreadPoolExecutor(max_workers=workers) if compute_hash and workers > 1 else None
+    pending = deque()
+    window = workers * 8
+
+    def collect(rel, fut):
+        entry = meta['files'][rel]
+        entry['hash'] = fut.result()
+        if on_hashed:
+            on_hashed(rel, entry)
+    n_stat = n_reused = n_inherited = n_listed = n_pruned = 0
+
+    def visit(rel, path, st):
+        nonlocal n_stat, n_reused, n_inherited, old_inodes
+        n_stat += 1
+        entry = stat_entry(st)
+
+        reuse = False
+        if compute_hash:
+            old = old_files.get(rel)
+            if old:
+                if (old['mtime'] == entry['mtime']
+                    and old['ctime'] == entry['ctime']
+                    and old['size']  == entry['size']):
+                    entry['hash'] = old['hash']
+                    reuse = True
+                    n_reused += 1
+            if not reuse and old_files:
+                # a file renamed since the last scan: same inode, size and mtime
+                if old_inodes is None:
+                    old_inodes = inode_index(old_files)
+                old_rel = old_inodes.get((st.st_dev, st.st_ino))
+                old = old_files.get(old_rel) if old_rel != rel else None
+                if old and inherits_hash(old, entry):
+                    entry['hash'] = old['hash']
+                    reuse = True
+                    n_inherited += 1
+
+        meta['files'][rel] = entry
+        if compute_hash and not reuse:
+            if pool:
+                pending.append((rel, pool.submit(hash_file, path, algorithm)))
+                while len(pending) > window or (pending and pending[0][1].done()):
+                    collect(*pending.popleft())
+            else:
+                entry['hash'] = hash_file(path, algorithm)
+                if on_hashed:
+                    on_hashed(rel, entry)
+
+    top = norm_path(folder_path, start) if start else folder_path
+    stack = [(start, top, os.stat(top).st_mtime)]
+    while stack:
+        rel_dir, root, dir_mtime = stack.pop()
         meta['dirs'].add(rel_dir)
 
-        for fn in files:
-            full = os.path.join(root, fn)
-            rel = os.path.join(rel_dir, fn) if rel_dir else fn
-            st = os.stat(full)
-            entry = {
-                "mtime": st.st_mtime,
-                "ctime": st.st_ctime,
-                "size":  st.st_size
-            }
-
-            if compute_hash:
-                reuse = False
-                if old_meta:
-                    old = old_meta.get('files', {}).get(rel)
-                    if old:
-                        if (old['mtime'] == entry['mtime']
-                            and old['ctime'] == entry['ctime']
-                            and old['size']  == entry['size']):
-                            entry['hash'] = old['hash']
-                            reuse = True
-
-                if not reuse:
-                    entry['hash'] = _hash_file(full)
-
-            meta['files'][rel] = entry
+        if rel_dir in old_dir_mtimes and old_dir_mtimes[rel_dir] == dir_mtime:
+            meta['dir_mtimes'][rel_dir] = dir_mtime
+            n_pruned += 1
+            files, subdirs = old_children.get(rel_dir, ([], []))
+            for rel in files:
+                if not (ignore and ignore(rel)):
+                    path = os.path.join(root, os.path.basename(rel))
+                    try:
+                        visit(rel, path, os.stat(path))
+                    except FileNotFoundError:
+                        pass
+            for name in subdirs:
+                full = os.path.join(root, name)
+                rel = os.path.join(rel_dir, name) if rel_dir else name
+                if ignore and ignore(rel, True):
+                    continue
+                try:
+                    st = os.stat(full)
+                except FileNotFoundError:
+                    continue
+                stack.append((rel, full, st.st_mtime))
+            continue
+
+        n_listed += 1
+        if settled_mtime(dir_mtime):
+            meta['dir_mtimes'][rel_dir] = dir_mtime
+        with os.scandir(root) as it:
+            for de in it:
+                rel = os.path.join(rel_dir, de.name) if rel_dir else de.name
+                if de.is_dir():
+                    # like os.walk, symlinked directories are not followed
+                    if not de.is_symlink() and not (ignore and ignore(rel, True)):
+                        stack.append((rel, de.path, de.stat().st_mtime))
+                    continue
+                if ignore and ignore(rel):
+                    continue
+                visit(rel, de.path, de.stat())
+
+    if pool:
+        try:
+            while pending:
+                collect(*pending.popleft())
+        finally:
+            pool.shutdown(cancel_futures=True)
 
+    stats.count('dirs_listed', n_listed)
+    stats.count('dirs_pruned', n_pruned)
+    stats.count('files_statted', n_stat)
+    stats.count('hash_reused', n_reused)
+    stats.count('hash_inherited', n_inherited)
     return meta
 
 
-def _hash_file(path):
-    h = hashlib.sha1()
-    with open(path, 'rb') as f:
-        for chunk in iter(lambda: f.read(8192), b''):
-            h.update(chunk)
+def rescan_paths(folder_path, old_meta, paths, workers=1, algorithm=DEFAULT_HASH,
+                 on_hashed=None, ignore=None):
+    # scan_folder for a known set of touched paths (files or dirs, relative): those
+    # are looked at again, everything else is taken from old_meta as is
+    paths = set(paths)
+    if '' in paths or hash_algorithm(old_meta) != algorithm:
+        return scan_folder(folder_path, old_meta=old_meta, workers=workers, algorithm=algorithm,
+                           on_hashed=on_hashed, ignore=ignore)
+
+    files = dict(old_meta['files'])
+    dirs = set(old_meta['dirs'])
+    dir_mtimes = dict(old_meta.get('dir_mtimes', {}))
+
+    # a path under another touched dir is covered by the rescan of that dir
+    roots = []
+    for rel in sorted(paths):
+        parent = os.path.dirname(rel)
+        while parent and parent not in paths:
+            parent = os.path.dirname(parent)
+        if not parent:
+            roots.append(rel)
+
+    # forget what used to be at (or under) each root
+    gone = tuple(rel + os.sep for rel in roots if rel in dirs)
+    if gone:
+        for rel in [f for f in files if f.startswith(gone)]:
+            del files[rel]
+        for d in [d for d in dirs if d.startswith(gone)]:
+            dirs.discard(d)
+            dir_mtimes.pop(d, None)
+
+    to_hash = []
+    old_inodes = None
+    for rel in roots:
+        old = files.pop(rel, None)
+        dirs.discard(rel)
+        dir_mtimes.pop(rel, None)
+
+        full = norm_path(folder_path, rel)
+        if ignored_path(ignore, rel):
+            continue
+        try:
+            st = os.stat(full)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        stats.count('files_statted')
+        if stat.S_ISDIR(st.st_mode) and ignored_path(ignore, rel, True):
+            continue
+
+        if stat.S_ISDIR(st.st_mode):
+            if os.path.islink(full):
+                continue
+            sub = scan_folder(folder_path, old_meta=old_meta, workers=workers, start=rel,
+                              algorithm=algorithm, on_hashed=on_hashed, ignore=ignore)
+            files.update(sub['files'])
+            dirs |= sub['dirs']
+            dir_mtimes.update(sub['dir_mtimes'])
+        else:
+            entry = stat_entry(st)
+            if (old and old['mtime'] == entry['mtime'] and old['ctime'] == entry['ctime']
+                    and old['size'] == entry['size']):
+                entry['hash'] = old['hash']
+                stats.count('hash_reused')
+            else:
+                if old_inodes is None:
+                    old_inodes = inode_index(old_meta['files'])
+                old_rel = old_inodes.get((st.st_dev, st.st_ino))
+                moved_from = old_meta['files'].get(old_rel) if old_rel != rel else None
+                if moved_from and inherits_hash(moved_from, entry):
+                    entry['hash'] = moved_from['hash']
+                    stats.count('hash_inherited')
+                else:
+                    to_hash.append(rel)
+            files[rel] = entry
+
+        parent = os.path.dirname(rel)
+        while parent not in dirs:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+
+    def try_hash(rel):
+        try:
+            return hash_file(norm_path(folder_path, rel), algorithm)
+        except FileNotFoundError:
+            return None  # gone again since the stat, e.g. a temp file
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for rel, h in zip(to_hash, pool.map(try_hash, to_hash)):
+            if h is None:
+                del files[rel]
+            else:
+                files[rel]['hash'] = h
+                if on_hashed:
+                    on_hashed(rel, files[rel])
+
+    return {'files': files, 'dirs': dirs, 'dir_mtimes': dir_mtimes}
+
+
+def stat_entry(st):
+    # metadata of one file from its stat; the inode lets a renamed file be
+    # recognized without reading it
+    return {
+        "mtime": st.st_mtime,
+        "ctime": st.st_ctime,
+        "size":  st.st_size,
+        "ino":   st.st_ino,
+        "dev":   st.st_dev,
+    }
+
+
+def inode_index(files):
+    # (dev, ino) -> rel path, for metadata entries that recorded them
+    return {(e['dev'], e['ino']): rel for rel, e in files.items() if 'ino' in e}
+
+
+def inherits_hash(old, entry):
+    # whether a file found at a new path under the inode of `old` still has its
+    # content. a rename changes the ctime but not the mtime or size
+    return (old.get('hash') is not None and old['size'] == entry['size']
+            and old['mtime'] == entry['mtime'])
+
+
+def hash_algorithm(meta):
+    return (meta or {}).get('hash_algorithm', DEFAULT_HASH)
+
+
+def settled_mtime(mtime):
+    # True when a later change to the dir is bound to give it another mtime
+    return mtime < time.time() - RACY_MTIME
+
+
+def _index_children(meta):
+    # parent dir -> ([file rel paths], [subdir names])
+    children = {}
+    for rel in meta.get('files', {}):
+        children.setdefault(os.path.dirname(rel), ([], []))[0].append(rel)
+    for d in meta.get('dirs', []):
+        if d:
+            children.setdefault(os.path.dirname(d), ([], []))[1].append(os.path.basename(d))
+    return children
+
+
+def new_hasher(algorithm=DEFAULT_HASH):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm: {algorithm}")
+    if algorithm == 'blake2b':
+        # 256-bit digests keep blob names (and delta ids made of two hashes) short
+        return hashlib.blake2b(digest_size=32)
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, algorithm=DEFAULT_HASH):
+    start = time.perf_counter()
+    h = new_hasher(algorithm)
+    # one large buffer per thread, read into in place; hashlib releases the GIL on
+    # big updates, so hashing threads run in parallel
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None:
+        buf = _hash_buffers.buf = memoryview(bytearray(HASH_READ_SIZE))
+    size = 0
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(buf[:n])
+            size += n
+    stats.count('files_hashed')
+    stats.count('hashed_bytes', size)
+    stats.count('hash_thread_seconds', time.perf_counter() - start)
     return h.hexdigest()
 
 
@@ -64,14 +341,28 @@ def save_json(path, data):
     if parent and not os.path.isdir(parent):
         os.makedirs(parent, exist_ok=True)
 
+    start = time.perf_counter()
     temp_path = path + '.tmp'
     with open(temp_path, 'w', encoding='utf-8') as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
         f.write("\n")
     os.replace(temp_path, path)
+    stats.count('json_writes')
+    stats.count('json_write_seconds', time.perf_counter() - start)
 
 
 
 def norm_path(base, rel_path):
     parts = rel_path.replace('\\', '/').split('/')
     return os.path.join(base, *parts)
+
+
+def temp_path(path):
+    # hidden sibling of path, for writing a file before renaming it into place
+    head, tail = os.path.split(path)
+    return os.path.join(head, f".{tail}.fsync-tmp")
+
+
+def blob_path(staging_dir, blob_id):
+    # staged blobs are content-addressed: <staging_dir>/<id[:2]>/<id>.enc
+    return os.path.join(staging_dir, blob_id[:2], blob_id + '.enc')
@@ -0,0 +1,331 @@
+import os
+import sys
+import time
+import errno
+import ctypes
+import ctypes.util
+import signal
+import select
+import struct
+import argparse
+import subprocess
+
+from utils import load_json, save_json, scan_folder
+from push import run_push
+from git_utils import pull_remote, set_sparse
+from peers import load_peers, sparse_dirs, own_paths
+from ignore import load_ignore, ignored_path, IGNORE_FILE
+
+# watch mode: folder changes are recorded as they happen into a journal of touched
+# paths, and pushed in batches. a batched push only rescans (and rehashes) the
+# journaled paths; a full scan still runs at startup, after an event overflow and
+# every watch_reconcile_interval seconds, to catch anything the events missed.
+#
+# changes are seen through linux inotify (one watch per directory), or by polling
+# the folder's stats where inotify is not available.
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (then len bytes of name)
+
+
+class _Inotify:
+    def __init__(self, folder_path, ignore=None):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.folder_path = folder_path
+        self.ignore = ignore
+        self.paths = {}  # wd -> relative dir
+        try:
+            self.add_tree('')
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_tree(self, rel_dir):
+        stack = [rel_dir]
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.folder_path, rel) if rel else self.folder_path
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e in (errno.ENOENT, errno.ENOTDIR):
+                    continue  # gone before we got to it
+                raise OSError(e, f"inotify_add_watch {path}: {os.strerror(e)}")
+            self.paths[wd] = rel
+            try:
+                with os.scandir(path) as it:
+                    for de in it:
+                        sub = os.path.join(rel, de.name) if rel else de.name
+                        if de.is_dir(follow_symlinks=False) and not ignored_path(self.ignore, sub, True):
+                            stack.append(sub)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def _moved_dir(self, old_rel, new_rel):
+        # the watches follow the moved inodes, only their paths change
+        prefix = old_rel + os.sep
+        for wd, rel in self.paths.items():
+            if rel == old_rel:
+                self.paths[wd] = new_rel
+            elif rel.startswith(prefix):
+                self.paths[wd] = new_rel + rel[len(old_rel):]
+
+    def _drop_tree(self, old_rel):
+        prefix = old_rel + os.sep
+        for wd in [wd for wd, rel in self.paths.items() if rel == old_rel or rel.startswith(prefix)]:
+            self.libc.inotify_rm_watch(self.fd, wd)
+            del self.paths[wd]
+
+    def wait(self, timeout):
+        # -> (touched relative paths, overflowed)
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set(), False
+
+        touched = set()
+        overflow = False
+        moved_from = {}  # cookie -> relative dir
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+                pos += EVENT.size
+                name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+                pos += length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+                    continue
+                parent = self.paths.get(wd)
+                if parent is None:
+                    continue
+                if not name:
+                    if parent == '' and mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                        overflow = True  # the folder itself went away
+                    continue
+
+                rel = os.path.join(parent, name) if parent else name
+                touched.add(rel)
+                if mask & IN_ISDIR:
+                    if mask & IN_MOVED_FROM:
+                        moved_from[cookie] = rel
+                    elif mask & IN_MOVED_TO and cookie in moved_from:
+                        self._moved_dir(moved_from.pop(cookie), rel)
+                    elif mask & (IN_CREATE | IN_MOVED_TO) and not ignored_path(self.ignore, rel, True):
+                        self.add_tree(rel)
+
+        # dirs moved out of the folder
+        for rel in moved_from.values():
+            self._drop_tree(rel)
+        return touched, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poller:
+    def __init__(self, folder_path, interval, ignore=None):
+        self.folder_path = folder_path
+        self.interval = interval
+        self.ignore = ignore
+        self.snapshot = scan_folder(folder_path, compute_hash=False, ignore=ignore)
+        self.next_poll = time.time() + interval
+
+    def wait(self, timeout):
+        now = time.time()
+        if now < self.next_poll:
+            time.sleep(min(timeout, self.next_poll - now))
+            return set(), False
+        self.next_poll = now + self.interval
+
+        snap = scan_folder(self.folder_path, compute_hash=False, ignore=self.ignore)
+        old, new = self.snapshot['files'], snap['files']
+        touched = old.keys() ^ new.keys()
+        touched.update(rel for rel in old.keys() & new.keys() if old[rel] != new[rel])
+        touched.update(self.snapshot['dirs'] ^ snap['dirs'])
+        self.snapshot = snap
+        return touched, False
+
+    def close(self):
+        pass
+
+
+def load_journal(path):
+    data = load_json(path) or {}
+    return {'full': bool(data.get('full', False)), 'paths': set(data.get('paths', []))}
+
+
+def save_journal(path, journal):
+    save_json(path, {
+        'updated_at': time.time(),
+        'full': journal['full'],
+        'paths': sorted(journal['paths']),
+    })
+
+
+def push_journal(cfg, journal, journal_path, full):
+    # -> True when the journaled changes made it into a push
+    taken = set(journal['paths'])
+
+    # other peers commit to the repo when they push or pull; catch up first or the push is rejected
+    git_cfg = cfg.get('git') or {}
+    if git_cfg.get('repo_path'):
+        repo_path = git_cfg['repo_path']
+        sparse = git_cfg.get('transport', 'full') == 'sparse'
+        try:
+            me, peers = load_peers(cfg)
+            if sparse:
+                set_sparse(repo_path, sparse_dirs(peers, repo_path))
+            pull_remote(repo_path, git_cfg.get('branch', 'main'), sparse=sparse,
+                        own=own_paths(peers, me))
+        except (subprocess.CalledProcessError, RuntimeError, KeyError, ValueError) as e:
+            print(f"Warning: could not update the sync repo, push postponed: {e}", file=sys.stderr)
+            return False
+
+    try:
+        run_push(cfg, touched=None if full else taken)
+    except Exception as e:
+        print(f"Warning: push failed, keeping the journal for the next one: {e}", file=sys.stderr)
+        return False
+    if full:
+        journal['full'] = False
+        journal['paths'].clear()
+    else:
+        journal['paths'] -= taken
+    save_journal(journal_path, journal)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Watch the folder and push its changes in batches."
+    )
+    parser.add_argument('-s', '--settings', required=True, help="Path to settings JSON")
+    parser.add_argument('--poll', action='store_true',
+                        help="poll the folder instead of using inotify")
+    args = parser.parse_args()
+
+    # ------- LOAD SETTINGS -------
+    cfg = load_json(args.settings)
+    folder_path     = cfg.get('folder_path')
+    metadata_path   = cfg.get('folder_metadata_path')
+    journal_path    = cfg.get('watch_journal_path')
+    interval        = float(cfg.get('watch_interval', 60))
+    debounce        = float(cfg.get('watch_debounce', 2))
+    reconcile_every = float(cfg.get('watch_reconcile_interval', 3600))
+    poll_interval   = float(cfg.get('watch_poll_interval', 10))
+    ignore          = load_ignore(cfg)
+
+    if not folder_path or not metadata_path:
+        print("Error: settings.json missing a required key.", file=sys.stderr)
+        sys.exit(1)
+    if not os.path.isdir(folder_path):
+        print(f"Error: folder not found: {folder_path}", file=sys.stderr)
+        sys.exit(1)
+    if not journal_path:
+        journal_path = os.path.join(os.path.dirname(os.path.abspath(metadata_path)),
+                                    'watch-journal.json')
+
+    # ------- START WATCHING -------
+    # before the first scan, so nothing changed during it is missed
+    source = None
+    if not args.poll:
+        try:
+            source = _Inotify(folder_path, ignore)
+            print(f"Watching {folder_path} with inotify ({len(source.paths)} dirs)")
+        except (AttributeError, OSError) as e:
+            print(f"Warning: inotify not available ({e}), polling instead", file=sys.stderr)
+    if source is None:
+        source = _Poller(folder_path, poll_interval, ignore)
+        print(f"Polling {folder_path} every {poll_interval:g}s")
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    # changes made while nobody was watching are only found by a full scan
+    journal = load_journal(journal_path)
+    journal['full'] = True
+    save_journal(journal_path, journal)
+
+    last_push = -interval
+    last_reconcile = time.time()
+    first_event = last_event = None
+    last_save = time.time()
+    dirty = False
+    try:
+        while True:
+            touched, overflow = source.wait(min(debounce, 1.0))
+            now = time.time()
+            # churn in ignored paths (swap files, build output) triggers nothing;
+            # new rules take a full scan to apply to what is already synced
+            touched = {rel for rel in touched if not ignored_path(ignore, rel)}
+            if IGNORE_FILE in touched:
+                ignore = source.ignore = load_ignore(cfg)
+                overflow = True
+            if touched or overflow:
+                journal['paths'] |= touched
+                journal['full'] = journal['full'] or overflow
+                last_event = now
+                first_event = first_event or now
+                dirty = True
+            if dirty and now - last_save >= 1.0:
+                save_journal(journal_path, journal)
+                last_save = now
+                dirty = False
+
+            # push once things have been quiet for a moment, but don't let a steady
+            # stream of writes hold a batch back for more than two intervals
+            full = ((journal['full'] and now - last_push >= interval)
+                    or now - last_reconcile >= reconcile_every)
+            quiet = last_event is None or now - last_event >= debounce
+            overdue = first_event is not None and now - first_event >= 2 * interval
+            if full or (journal['paths'] and now - last_push >= interval and (quiet or overdue)):
+                if full:
+                    print(f"Reconciling: full scan of {folder_path}")
+                elif journal['paths']:
+                    print(f"Pushing {len(journal['paths'])} changed path(s)")
+                if push_journal(cfg, journal, journal_path, full):
+                    first_event = None
+                    if full:
+                        last_reconcile = now
+                last_push = now
+                last_save = time.time()
+                dirty = False
+    except KeyboardInterrupt:
+        pass
+    finally:
+        save_journal(journal_path, journal)
+        source.close()
+
+
+if __name__ == '__main__':
+    main()